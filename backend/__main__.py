@@ -0,0 +1,118 @@
+#__main__.py
+import sys
+import json
+import zipfile
+import argparse
+from backend import instrumentation
+from backend.code_similarity_detection import extract_paths, sanitize_title
+from backend.code_clustering import CodeClusterer, StreamingCodeClusterer, find_elbow_point
+from backend.fingerprint_cache import DEFAULT_CACHE_PATH
+from backend.pairwise_engine import run_pairwise, DEFAULT_CHUNK_SIZE
+from backend.similarity_results import SimilarityResults
+from backend.results_io import write_parquet, is_parquet, CLUSTERED_COLUMNS
+
+# Function to build the command-line interface of the batch runner
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m backend",
+        description="Detect similarity between Python files and cluster the results, without the web app."
+    )
+    parser.add_argument("inputs", nargs="+", help="directories (searched recursively), ZIP archives or .py files")
+    parser.add_argument("-o", "--output", help="output file, .csv or .parquet (default: <title>_clustered_codes.csv)")
+    parser.add_argument("-t", "--title", default="batch", help="title of the code activity (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE, help="file pairs per worker task (default: %(default)s)")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH, help="fingerprint and pair-score cache file (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the cache")
+    parser.add_argument("--fast", action="store_true", help="only fully compare pairs that look alike at a glance")
+    parser.add_argument("--streaming", action="store_true", help="cluster pairs in chunks while they are compared (MiniBatchKMeans), for very large runs")
+    parser.add_argument("--max-clusters", type=int, default=10, help="largest number of clusters tried (default: %(default)s)")
+    parser.add_argument("--report", help="JSON file to write the stage timings and counters of the run to")
+    parser.add_argument("--profile", action="store_true", help="add a cProfile listing of the main process to the report")
+    parser.add_argument("--trace-memory", action="store_true", help="add the peak memory of the main process to the report (tracemalloc, slow)")
+    return parser
+
+# Function to cluster the similarity results the same way the App does
+def cluster_results(similarity_df, max_clusters, clusterer=None):
+    if len(similarity_df) < 2:
+        raise ValueError("Clustering cannot be performed because there are not enough distinct samples.")
+
+    # Find the best number of clusters with the elbow method
+    clusterer = clusterer or CodeClusterer(num_clusters=2)
+    clusterer.load_data(similarity_df)
+    clusterer.calculate_elbow(max_clusters=min(max_clusters, len(similarity_df)))
+    best_num_clusters = find_elbow_point(clusterer.elbow_scores)
+
+    # Cluster with the best number of clusters, reusing the model fitted by the elbow sweep
+    clusterer.set_num_clusters(best_num_clusters)
+    clusterer.cluster_codes()
+    return clusterer.get_clustered_data(), clusterer
+
+# Function to write a run report as JSON
+def write_report(report, path):
+    with open(path, 'w', encoding='utf-8') as output:
+        json.dump(report.to_dict(), output, indent=2)
+    print(f"Wrote the run report to {path}.", file=sys.stderr)
+
+# Function to run the whole pipeline from the command line, recording a run report when asked for
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if not (args.report or args.profile or args.trace_memory):
+        return run_pipeline(args)
+
+    with instrumentation.record_run(profile=args.profile, trace_memory=args.trace_memory) as report:
+        status = run_pipeline(args)
+    write_report(report, args.report or f"{sanitize_title(args.title)}_run_report.json")
+    return status
+
+# Function to run the pipeline with parsed command-line arguments
+def run_pipeline(args):
+    output = args.output or f"{sanitize_title(args.title)}_clustered_codes.csv"
+
+    try:
+        extracted_files, extracted_files_content = extract_paths(args.inputs)
+    except (OSError, ValueError, zipfile.BadZipFile) as e:
+        print(f"Could not read the input files: {e}", file=sys.stderr)
+        return 1
+    if len(extracted_files) < 2:
+        print("At least two Python files are needed.", file=sys.stderr)
+        return 1
+    print(f"Read {len(extracted_files)} Python files.", file=sys.stderr)
+
+    # Compare every pair of files, reporting progress on stderr
+    results = SimilarityResults()
+    streaming_clusterer = StreamingCodeClusterer(max_clusters=args.max_clusters) if args.streaming else None
+    for progress in run_pairwise(extracted_files, extracted_files_content, results, progress_interval=5,
+                                 processes=args.workers, chunk_size=args.chunk_size, prune_candidates=args.fast,
+                                 cache_path=None if args.no_cache else args.cache):
+        print(f"Compared {progress.done:,} of {progress.total:,} pairs ({progress.pairs_per_second:,.0f} pairs/s)", file=sys.stderr)
+        if streaming_clusterer:
+            streaming_clusterer.consume(results)  # Update the clusters with the pairs scored since the last report
+
+    try:
+        clustered_data, clusterer = cluster_results(results.to_dataframe(), args.max_clusters, streaming_clusterer)
+    except ValueError as e:
+        if "Number of labels is 1" in str(e):
+            print("All files are identical, resulting in only one cluster.", file=sys.stderr)
+        else:
+            print(f"Error clustering data: {e}", file=sys.stderr)
+        return 1
+    print(f"Clustered into {clusterer.num_clusters} clusters (silhouette score {clusterer.silhouette_avg:.4f}).", file=sys.stderr)
+    if clusterer.silhouette_sample_size < clusterer.silhouette_population:
+        print(f"Silhouette score computed on a stratified sample of {clusterer.silhouette_sample_size:,} pairs.", file=sys.stderr)
+
+    # Write the clustered codes in the same layout as the App's download
+    df = clustered_data[CLUSTERED_COLUMNS]
+    try:
+        if is_parquet(output):
+            write_parquet(df, output, title=args.title, num_clusters=clusterer.num_clusters)
+        else:
+            df.to_csv(output, index=False)
+    except ImportError as e:  # Parquet needs pyarrow
+        print(f"Could not write {output}: {e}", file=sys.stderr)
+        return 1
+    print(f"Wrote {len(df):,} pairs to {output}.", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+#analysis.py
+import numpy as np
+import pandas as pd
+from backend.results_io import CLUSTERED_COLUMNS
+
+# Similarity columns of a clustered results table
+SIMILARITY_COLUMNS = ['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']
+
+# Columns of the per-code averages table
+AVERAGE_COLUMNS = ['average_text_similarity', 'average_structural_similarity', 'average_weighted_similarity']
+
+# Colour-coded similarity bands as (label, lowest percentage, colour); a band reaches up to the next band's lowest percentage
+SIMILARITY_BANDS = [
+    ('Blue (0%)', 0, '#6A9AB0'),
+    ('Green (1% - 24%)', 1, '#557C56'),
+    ('Yellow (25% - 49%)', 25, '#EEDF7A'),
+    ('Orange (50% - 74%)', 50, '#D8A25E'),
+    ('Red (75% - 100%)', 75, '#A04747'),
+]
+
+# Function to list the required columns missing from a results table (names compared ignoring case and spaces)
+def find_missing_columns(dataframe):
+    present = {column.strip().lower() for column in dataframe.columns}
+    return [column.lower() for column in CLUSTERED_COLUMNS if column.lower() not in present]
+
+# Function to bring a results table into the canonical column names and order, with similarities as float64 rounded
+# to 2 decimals, so tables saved as float32 filter and average the same as CSV files
+def normalize_results(dataframe):
+    canonical = {column.lower(): column for column in CLUSTERED_COLUMNS}
+    dataframe = dataframe.rename(columns=lambda column: canonical.get(column.strip().lower(), column))
+    dataframe = dataframe[CLUSTERED_COLUMNS]
+    return dataframe.assign(**{column: dataframe[column].astype(np.float64).round(2) for column in SIMILARITY_COLUMNS})
+
+# Function to calculate the summary statistics of a results table
+def summary_statistics(dataframe):
+    return dataframe.describe()
+
+# Function to calculate the average similarities of every code over all of its comparisons, highest weighted first
+def code_averages(dataframe):
+    averages = dataframe.groupby('Code1', observed=True).agg(
+        average_text_similarity=('Text_Similarity_%', 'mean'),
+        average_structural_similarity=('Structural_Similarity_%', 'mean'),
+        average_weighted_similarity=('Weighted_Similarity_%', 'mean')
+    ).reset_index()
+
+    # Handle missing data by filling NaNs with 0 and round results for display
+    averages[AVERAGE_COLUMNS] = averages[AVERAGE_COLUMNS].fillna(0).round(2)
+    return averages.sort_values(by='average_weighted_similarity', ascending=False)
+
+# Function to find the band of every value in a single pass; values below the first band's bound get the first band
+def band_codes(values, bands=SIMILARITY_BANDS):
+    return np.digitize(np.asarray(values, dtype=np.float64), [lowest for _, lowest, _ in bands[1:]])
+
+# Function to count the values of every band; returns the counts and the band code of every value
+def band_counts(values, bands=SIMILARITY_BANDS):
+    codes = band_codes(values, bands)
+    return np.bincount(codes, minlength=len(bands)), codes
+
+# Function to count how many values fall into each colour-coded similarity range
+def count_by_similarity_range(values, bands=SIMILARITY_BANDS):
+    counts, _ = band_counts(values, bands)
+    return {label: int(count) for (label, _, _), count in zip(bands, counts)}
+
+# Function to label every value with its band, as a categorical that stores one small code per value
+def band_labels(values, bands=SIMILARITY_BANDS):
+    return pd.Categorical.from_codes(band_codes(values, bands), [label for label, _, _ in bands])
+
+# Function to build the CSS background of every value from its band, for Styler.apply on a whole column
+def band_styles(values, bands=SIMILARITY_BANDS):
+    styles = np.array([f'background-color: {colour}' for _, _, colour in bands])
+    return styles[band_codes(values, bands)]
+
+# Function to build the per-band count table, one row per band
+def band_summary(values, label_column='Similarity Range', bands=SIMILARITY_BANDS):
+    counts, _ = band_counts(values, bands)
+    return pd.DataFrame({label_column: [label for label, _, _ in bands], 'Count': counts})
+
+# Function to colour every row of a band_summary table with its band's colour, for Styler.apply(axis=None)
+def band_summary_styles(summary, bands=SIMILARITY_BANDS):
+    styles = np.array([f'background-color: {colour}' for _, _, colour in bands])
+    return pd.DataFrame(np.repeat(styles[:, None], summary.shape[1], axis=1), index=summary.index, columns=summary.columns)
@@ -0,0 +1,306 @@
+#benchmark.py
+import io
+import ast
+import os
+import re
+import sys
+import json
+import time
+import random
+import zipfile
+import argparse
+import textwrap
+import platform
+import tracemalloc
+from itertools import combinations, islice
+from backend.code_similarity_detection import (
+    extract_files, scan_code, generate_hash_signature, ALGORITHM_VERSION
+)
+from backend.normalizedAST import parse_code_to_encoded_ast
+from backend.structural_similarity import compare_ast_texts, ast_text
+from backend.pairwise_engine import run_pairwise
+from backend.similarity_results import SimilarityResults
+from backend.code_clustering import CodeClusterer, find_elbow_point
+
+# Words the generated identifiers are made of
+_WORDS = ['total', 'count', 'value', 'items', 'result', 'index', 'data', 'score', 'limit', 'offset',
+          'width', 'height', 'level', 'price', 'amount', 'buffer', 'weight', 'factor', 'step', 'size']
+
+# Statement templates of the generated function bodies; {a} and {b} are variables, {n} a number
+_STATEMENTS = [
+    "{a} = {b} + {n}",
+    "{a} = {b} * {n} - {a}",
+    "for i in range({n}):\n    {a} += i * {b}",
+    "if {a} > {n}:\n    {b} = {a} - {n}\nelse:\n    {b} = {n}",
+    "while {a} < {n}:\n    {a} += {b} + 1",
+    "{a} = [x * {n} for x in range({b})]",
+    "{a} = sum({b} for _ in range({n}))",
+    "{a} = max({a}, {b}, {n})",
+]
+
+# Function to generate one random function as a list of lines, with a few comments
+def _random_function(rng, index, num_statements):
+    words = rng.sample(_WORDS, 4)
+    lines = [f"def compute_{words[0]}_{index}({words[1]}, {words[2]}):", f'    """Compute the {words[0]} of the {words[1]}."""',
+             f"    {words[3]} = {words[1]}"]
+    for _ in range(num_statements):
+        if rng.random() < 0.3:
+            lines.append(f"    # Update the {rng.choice(words)}")
+        a, b = rng.sample(words[1:], 2)
+        statement = rng.choice(_STATEMENTS).format(a=a, b=b, n=rng.randint(1, 99))
+        lines.extend("    " + line for line in statement.splitlines())
+    lines.append(f"    return {words[3]}")
+    return lines
+
+# Function to generate an original submission as a list of functions (each a list of lines)
+def generate_submission(rng, functions_per_file, statements_per_function):
+    return [_random_function(rng, index, statements_per_function) for index in range(functions_per_file)]
+
+# Plagiarism transform: rename every generated identifier consistently
+def rename_identifiers(rng, functions):
+    renames = {word: f"{word}_{rng.choice(['v', 'tmp', 'my', 'new'])}" for word in _WORDS}
+    pattern = re.compile(r'\b(' + '|'.join(_WORDS) + r')\b')
+    # Comments and docstrings keep their words; only code lines are renamed
+    return [[line if line.lstrip().startswith(('#', '"""')) else pattern.sub(lambda match: renames[match.group(1)], line)
+             for line in function] for function in functions]
+
+# Plagiarism transform: put the functions in a different order
+def reorder_functions(rng, functions):
+    functions = list(functions)
+    rng.shuffle(functions)
+    return functions
+
+# Function to split a generated function into its fixed head (up to the docstring) and its statements, each a list of
+# lines with the comments above it; the return statement is the last one
+def _split_statements(function):
+    head_length = next(index for index, line in enumerate(function) if line.lstrip().startswith('"""')) + 1
+    statements, comments = [], []
+    for line in function[head_length:]:
+        if line.lstrip().startswith('#'):
+            comments.append(line)
+        elif line.startswith('    ' * 2) or line.lstrip().startswith('else:'):
+            statements[-1].append(line)  # Body of a for, while or if statement
+        else:
+            statements.append(comments + [line])
+            comments = []
+    return function[:head_length], statements, comments
+
+# Function to list the names a statement assigns and the names it uses
+def _statement_names(statement):
+    tree = ast.parse(textwrap.dedent("\n".join(statement)))
+    written, used = set(), set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (written if isinstance(node.ctx, ast.Store) else used).add(node.id)
+    return written, used | written  # An assignment such as a += b also uses a
+
+# Plagiarism transform: swap statements of every function body that do not depend on each other, so the program
+# computes the same results in a different order
+def reorder_statements(rng, functions):
+    reordered = []
+    for function in functions:
+        head, statements, trailing = _split_statements(function)
+        body, ret = statements[:-1], statements[-1]
+        names = [_statement_names(statement) for statement in body]
+        for _ in range(len(body) - 1):
+            index = rng.randrange(len(body) - 1)
+            (written1, used1), (written2, used2) = names[index], names[index + 1]
+            if not (written1 & used2 or written2 & used1):
+                body[index], body[index + 1] = body[index + 1], body[index]
+                names[index], names[index + 1] = names[index + 1], names[index]
+        reordered.append(head + [line for statement in body + [ret] for line in statement] + trailing)
+    return reordered
+
+# Plagiarism transform: drop the original comments and add different ones
+def change_comments(rng, functions):
+    changed = []
+    for function in functions:
+        lines = [line for line in function if not line.lstrip().startswith('#')]
+        lines.insert(1, f"    # {rng.choice(['helper', 'main logic', 'see task 2', 'my own solution'])}")
+        changed.append(lines)
+    return changed
+
+# Every plagiarism transform, by name
+PLAGIARISM_TRANSFORMS = {
+    'rename_identifiers': rename_identifiers,
+    'reorder_functions': reorder_functions,
+    'reorder_statements': reorder_statements,
+    'change_comments': change_comments,
+}
+
+# Function to generate a corpus of submissions, part of them plagiarised from others; returns {file name: code} and the copies made
+def generate_corpus(num_files, functions_per_file=8, statements_per_function=6, plagiarism_rate=0.3, seed=0):
+    rng = random.Random(seed)
+    submissions = {}
+    copies = []  # (copy, original, transforms applied) of every plagiarised file
+    for index in range(num_files):
+        file_name = f"student_{index:05d}.py"
+        if submissions and rng.random() < plagiarism_rate:
+            # Copy an earlier submission and disguise it with one or more transforms
+            original = rng.choice(list(submissions))
+            transforms = rng.sample(list(PLAGIARISM_TRANSFORMS), rng.randint(1, len(PLAGIARISM_TRANSFORMS)))
+            functions = submissions[original]
+            for transform in transforms:
+                functions = PLAGIARISM_TRANSFORMS[transform](rng, functions)
+            copies.append((file_name, original, transforms))
+        else:
+            functions = generate_submission(rng, functions_per_file, statements_per_function)
+        submissions[file_name] = functions
+
+    corpus = {file_name: "\n\n\n".join("\n".join(function) for function in functions) + "\n"
+              for file_name, functions in submissions.items()}
+    return corpus, copies
+
+# Function to pack a corpus into an in-memory ZIP that behaves like an uploaded file
+def corpus_upload(corpus):
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for file_name, code in corpus.items():
+            archive.writestr(file_name, code)
+    buffer.seek(0)
+    buffer.name = "corpus.zip"  # Uploaded files carry their name
+    return buffer
+
+# Class for timing a stage and, while tracemalloc is tracing, recording its peak memory
+class _Stage:
+    def __init__(self, stages, name, items):
+        self.stages = stages  # Dictionary the measurement is stored in
+        self.name = name
+        self.items = items  # Number of files or pairs the stage handles
+
+    def __enter__(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        seconds = time.perf_counter() - self.start
+        self.stages[self.name] = {
+            'seconds': seconds,
+            'items': self.items,
+            'items_per_second': self.items / seconds if seconds > 0 else None,
+            # Of this process only; worker processes are not traced
+            'peak_memory_bytes': tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None,
+        }
+
+# Function to benchmark every stage of the pipeline on one corpus
+def benchmark_corpus(corpus, workers=None, max_ast_pairs=20_000, max_clusters=10):
+    stages = {}
+    num_files = len(corpus)
+    num_pairs = num_files * (num_files - 1) // 2
+
+    with _Stage(stages, 'extract_files', num_files):
+        extracted_files, extracted_files_content = extract_files([corpus_upload(corpus)])
+    codes = [extracted_files_content[file_path] for file_path in extracted_files]
+
+    with _Stage(stages, 'scan_code', num_files):
+        scanned = [scan_code(code) for code in codes]
+    with _Stage(stages, 'simhash', num_files):
+        [generate_hash_signature(scanned_code.tokens) for scanned_code in scanned]
+    with _Stage(stages, 'normalize_ast', num_files):
+        encoded_asts = [parse_code_to_encoded_ast(scanned_code.text) for scanned_code in scanned]
+
+    # Structural comparison on its own, in this process, over at most max_ast_pairs pairs
+    ast_pairs = list(islice(combinations(range(num_files), 2), max_ast_pairs))
+    ast_texts = [ast_text(encoded_ast) for encoded_ast in encoded_asts]  # Joined once per file, as fingerprints do
+    with _Stage(stages, 'compare_asts', len(ast_pairs)):
+        for i, j in ast_pairs:
+            compare_ast_texts(ast_texts[i], ast_texts[j])
+
+    # The whole pairwise stage, with the worker pool and without the on-disk caches
+    results = SimilarityResults()
+    with _Stage(stages, 'pairwise', num_pairs):
+        for _ in run_pairwise(extracted_files, extracted_files_content, results, progress_interval=float('inf'), processes=workers):
+            pass
+
+    similarity_df = results.to_dataframe()
+    clusterer = CodeClusterer(num_clusters=2)
+    clusterer.load_data(similarity_df)
+    with _Stage(stages, 'kmeans_elbow', len(similarity_df)):
+        clusterer.calculate_elbow(max_clusters=min(max_clusters, len(similarity_df)))
+    clusterer.set_num_clusters(find_elbow_point(clusterer.elbow_scores))
+    with _Stage(stages, 'kmeans_fit_and_silhouette', len(similarity_df)):
+        clusterer.cluster_codes()
+
+    return {
+        'num_files': num_files,
+        'num_pairs': num_pairs,
+        'total_bytes': sum(len(code.encode('utf-8')) for code in codes),
+        'stages': stages,
+    }
+
+# Function to run the benchmark over several corpus sizes and collect the scaling curves
+def run_benchmark(sizes, functions_per_file=8, statements_per_function=6, plagiarism_rate=0.3, seed=0, workers=None,
+                  max_ast_pairs=20_000, trace_memory=True):
+    runs = []
+    for size in sizes:
+        corpus, copies = generate_corpus(size, functions_per_file, statements_per_function, plagiarism_rate, seed)
+        run = benchmark_corpus(corpus, workers, max_ast_pairs)  # Timed without tracemalloc, which slows allocations down many times
+        run['plagiarised_files'] = len(copies)
+
+        if trace_memory:
+            # A second pass with tracemalloc only for the peak memory of every stage
+            tracemalloc.start()
+            try:
+                traced = benchmark_corpus(corpus, workers, max_ast_pairs)
+            finally:
+                tracemalloc.stop()
+            for stage, measurement in run['stages'].items():
+                measurement['peak_memory_bytes'] = traced['stages'][stage]['peak_memory_bytes']
+        runs.append(run)
+
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'algorithm_version': ALGORITHM_VERSION,
+        },
+        'settings': {
+            'functions_per_file': functions_per_file,
+            'statements_per_function': statements_per_function,
+            'plagiarism_rate': plagiarism_rate,
+            'seed': seed,
+            'workers': workers,
+            'max_ast_pairs': max_ast_pairs,
+            'trace_memory': trace_memory,
+        },
+        'runs': runs,
+        # Seconds of every stage against the number of files, one curve per stage
+        'scaling': {stage: [[run['num_files'], run['stages'][stage]['seconds']] for run in runs] for stage in runs[0]['stages']} if runs else {},
+    }
+
+# Function to build the command-line interface of the benchmark
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="python -m backend.benchmark",
+        description="Time every pipeline stage on synthetic corpora with plagiarised submissions and report the results as JSON."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[20, 50, 100], help="numbers of files to benchmark (default: %(default)s)")
+    parser.add_argument("--functions", type=int, default=8, help="functions per generated file (default: %(default)s)")
+    parser.add_argument("--statements", type=int, default=6, help="statements per generated function (default: %(default)s)")
+    parser.add_argument("--plagiarism", type=float, default=0.3, help="share of files copied from another file (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the corpus (default: %(default)s)")
+    parser.add_argument("-w", "--workers", type=int, default=None, help="number of worker processes (default: all cores)")
+    parser.add_argument("--max-ast-pairs", type=int, default=20_000, help="pairs timed in the compare_asts stage (default: %(default)s)")
+    parser.add_argument("--no-memory", action="store_true", help="skip the second, traced pass that measures peak memory")
+    parser.add_argument("-o", "--output", help="JSON file to write (default: standard output)")
+    return parser
+
+# Function to run the benchmark from the command line
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    report = run_benchmark(args.sizes, args.functions, args.statements, args.plagiarism, args.seed, args.workers,
+                           args.max_ast_pairs, trace_memory=not args.no_memory)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            output.write(text)
+        print(f"Wrote the benchmark report to {args.output}.", file=sys.stderr)
+    else:
+        print(text)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+#candidate_pruning.py
+from array import array
+import numpy as np
+from backend.code_similarity_detection import iter_text_similarity_blocks, calculate_weighted_similarity
+
+# MinHash banding over shingles of consecutive AST node types
+MINHASH_PERMUTATIONS = 128  # Length of each MinHash signature
+MINHASH_BANDS = 16  # 16 bands of 8 signature rows each; structures agreeing on 90% of the signature collide almost surely
+SHINGLE_SIZE = 4  # Number of consecutive node types per shingle
+
+# Pairs at or above this text similarity are always scored in full. Below it only a structural similarity of 75% or
+# more can lift the weighted similarity into the red band (75% - 100%), and such structures collide in a MinHash band
+DEFAULT_TEXT_SIMILARITY_THRESHOLD = 0.75
+
+# Parameters of the universal hash functions that simulate the MinHash permutations
+_MINHASH_PRIME = (1 << 31) - 1  # Small enough that a * x + b never overflows uint64
+_MINHASH_RANDOM_STATE = np.random.RandomState(42)
+_MINHASH_A = _MINHASH_RANDOM_STATE.randint(1, _MINHASH_PRIME, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+_MINHASH_B = _MINHASH_RANDOM_STATE.randint(0, _MINHASH_PRIME, size=MINHASH_PERMUTATIONS).astype(np.uint64)
+
+# Function to get the sequence of AST node-type codes of a fingerprint
+def ast_node_types(fingerprint):
+    if fingerprint.encoded_ast is None:  # Code that does not parse has no structure to compare
+        return array('H')
+    codes, _ = fingerprint.encoded_ast  # Drop the depths, keep the node types
+    return codes
+
+# Odd 64-bit multiplier that spreads the packed shingles over the hash range (Fibonacci hashing)
+_SHINGLE_MULTIPLIER = np.uint64(0x9E3779B97F4A7C15)
+
+# Function to calculate the MinHash signature of a file's AST node-type shingles
+def minhash_signature(node_types):
+    codes = np.frombuffer(node_types, dtype=np.uint16).astype(np.uint64) if len(node_types) else np.empty(0, dtype=np.uint64)
+    if len(codes) < SHINGLE_SIZE:  # Too little structure to build a single shingle
+        return None
+
+    # Pack every run of SHINGLE_SIZE 16-bit node types into one 64-bit value, then hash it down to 31 bits
+    packed = np.zeros(len(codes) - SHINGLE_SIZE + 1, dtype=np.uint64)
+    for offset in range(SHINGLE_SIZE):
+        packed = (packed << np.uint64(16)) | codes[offset:len(codes) - SHINGLE_SIZE + 1 + offset]
+    shingle_hashes = np.unique((packed * _SHINGLE_MULTIPLIER) >> np.uint64(33))
+
+    # Apply every hash function to every shingle and keep the minimum per hash function
+    return ((_MINHASH_A[:, None] * shingle_hashes[None, :] + _MINHASH_B[:, None]) % _MINHASH_PRIME).min(axis=1)
+
+# Function to calculate the MinHash signatures of all fingerprints as one array
+def minhash_signatures(fingerprints):
+    signatures = np.zeros((len(fingerprints), MINHASH_PERMUTATIONS), dtype=np.uint64)
+    has_signature = np.zeros(len(fingerprints), dtype=bool)  # Files without any shingle never collide
+    for index, fingerprint in enumerate(fingerprints):
+        signature = minhash_signature(ast_node_types(fingerprint))
+        if signature is not None:
+            signatures[index] = signature
+            has_signature[index] = True
+    return signatures, has_signature
+
+# Function to pick the smallest unsigned type that holds the pair code i * num_files + j of every pair
+def _pair_code_dtype(num_files):
+    return np.uint32 if num_files * num_files <= np.iinfo(np.uint32).max else np.uint64
+
+# Function to turn (i, j) pair codes back into index pairs, one at a time
+def decode_pairs(codes, num_files):
+    for code in codes.tolist():
+        yield divmod(code, num_files)
+
+# Function to find the pair codes of all files that share a key (one row of keys per file); i < j in every pair
+def _colliding_pairs(keys, num_files):
+    dtype = _pair_code_dtype(num_files)
+    _, groups = np.unique(keys, axis=0, return_inverse=True)
+    order = np.argsort(groups.ravel(), kind='stable')  # Files of one group next to each other, in index order
+    bounds = np.flatnonzero(np.diff(groups.ravel()[order])) + 1
+    codes = []
+    for members in np.split(order, bounds):
+        if len(members) < 2:
+            continue
+        first, second = np.triu_indices(len(members), 1)
+        codes.append(members[first].astype(dtype) * dtype(num_files) + members[second].astype(dtype))
+    return np.concatenate(codes) if codes else np.empty(0, dtype=dtype)
+
+# Function to find candidate pairs that collide in at least one MinHash band, as sorted pair codes
+def find_banded_candidates(signatures, has_signature):
+    num_files = len(signatures)
+    candidates = np.empty(0, dtype=_pair_code_dtype(num_files))
+
+    # Equal rows in one slice of the signature; files without a signature never collide
+    with_signature = np.flatnonzero(has_signature)
+    rows_per_band = MINHASH_PERMUTATIONS // MINHASH_BANDS
+    for band in range(MINHASH_BANDS):
+        band_rows = signatures[with_signature, band * rows_per_band:(band + 1) * rows_per_band]
+        local_codes = _colliding_pairs(band_rows, len(with_signature))
+        # Map the positions among the files with a signature back to file indices
+        first, second = np.divmod(local_codes, local_codes.dtype.type(max(len(with_signature), 1)))
+        dtype = candidates.dtype
+        codes = with_signature[first].astype(dtype) * dtype.type(num_files) + with_signature[second].astype(dtype)
+        candidates = np.union1d(candidates, codes)
+
+    return candidates
+
+# Function to find pairs whose text similarity reaches the threshold, as sorted pair codes
+def find_threshold_candidates(hash_signatures, text_similarity_threshold):
+    num_files = len(hash_signatures)
+    dtype = _pair_code_dtype(num_files)
+    codes = []
+    # Compare row blocks against the whole corpus so memory stays bounded
+    for start, similarities in iter_text_similarity_blocks(hash_signatures):
+        rows, columns = np.nonzero(similarities >= text_similarity_threshold)
+        rows = rows + start
+        keep = rows < columns  # Keep each unordered pair once
+        codes.append(rows[keep].astype(dtype) * dtype(num_files) + columns[keep].astype(dtype))
+    return np.concatenate(codes) if codes else np.empty(0, dtype=dtype)
+
+# Function to find every pair that deserves full structural scoring, as sorted pair codes i * num_files + j
+def find_candidate_pairs(fingerprints, text_similarity_threshold=DEFAULT_TEXT_SIMILARITY_THRESHOLD):
+    hash_signatures = [fingerprint.simhash for fingerprint in fingerprints]
+    signatures, has_signature = minhash_signatures(fingerprints)
+    candidates = find_banded_candidates(signatures, has_signature)
+    return np.union1d(candidates, find_threshold_candidates(hash_signatures, text_similarity_threshold))
+
+# Function to score every pair that was pruned from full structural scoring; skip_pairs holds (i, j) pairs scored elsewhere
+def score_pruned_pairs(fingerprints, candidates, skip_pairs=()):
+    num_files = len(fingerprints)
+    hash_signatures = [fingerprint.simhash for fingerprint in fingerprints]
+
+    for start, block in iter_text_similarity_blocks(hash_signatures):
+        for i in range(start, min(start + len(block), num_files - 1)):
+            text_similarities = block[i - start, i + 1:]
+
+            # Candidates of this row get full scoring elsewhere
+            pruned = np.ones(num_files - i - 1, dtype=bool)
+            row_codes = candidates[np.searchsorted(candidates, i * num_files):np.searchsorted(candidates, (i + 1) * num_files)]
+            pruned[row_codes.astype(np.int64) - i * num_files - i - 1] = False
+
+            for offset in np.flatnonzero(pruned).tolist():
+                j = i + 1 + offset
+                if (i, j) in skip_pairs:
+                    continue
+                # Text similarity is exact; the structure is not compared and counts as 0, so the weighted
+                # similarity is the lowest the full comparison could give and never puts the pair in a higher band
+                text_similarity = float(text_similarities[offset])
+                yield (
+                    fingerprints[i].name,
+                    fingerprints[j].name,
+                    text_similarity,
+                    0.0,
+                    calculate_weighted_similarity(text_similarity, 0.0),
+                )
@@ -1,7 +1,31 @@
 import pandas as pd
-from sklearn.cluster import KMeans
+from joblib import Parallel, delayed
+from sklearn.cluster import KMeans, MiniBatchKMeans, AgglomerativeClustering, DBSCAN
 from sklearn.metrics import silhouette_score, davies_bouldin_score, silhouette_samples
 import numpy as np
+from backend import instrumentation
+
+# Above this many rows, MiniBatchKMeans is used instead of full-batch KMeans
+MINIBATCH_THRESHOLD = 50_000
+
+# Function to create the KMeans model for a number of clusters, picking MiniBatchKMeans for large tables
+def make_kmeans(num_clusters, num_rows):
+    if num_rows > MINIBATCH_THRESHOLD:
+        return MiniBatchKMeans(n_clusters=num_clusters, random_state=42, batch_size=4096, n_init=3)
+    return KMeans(n_clusters=num_clusters, random_state=42)
+
+# Number of rows per update of the streaming clusterer
+STREAMING_CHUNK_SIZE = 4096
+
+# Similarity columns the pairs are clustered on
+FEATURE_COLUMNS = ['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']
+
+# Above this many rows, silhouette values are computed on a stratified sample instead of every row
+MAX_SILHOUETTE_SAMPLES = 10_000
+
+# Function to fit one model of the elbow sweep; runs in a worker process
+def _fit_kmeans(num_clusters, features):
+    return make_kmeans(num_clusters, len(features)).fit(features)
 
 # Class for code clustering
 class CodeClusterer:
@@ -10,11 +34,17 @@ class CodeClusterer:
         self.data = None  # Placeholder for the input data DataFrame
         self.model = KMeans(n_clusters=num_clusters, random_state=42)  # Initialize KMeans model with specified clusters
         self.elbow_scores = []  # Initialize an empty list to store elbow scores (inertia values)
+        self.elbow_models = {}  # Fitted models of the elbow sweep, by number of clusters
         self.silhouette_avg = None  # Initialize placeholder for average silhouette score
         self.davies_bouldin = None  # Initialize placeholder for Davies-Bouldin score
+        self.silhouette_values = None  # Silhouette value of every scored row, reused by get_silhouette_data
+        self.silhouette_rows = None  # Positions of the scored rows (all rows unless sampled)
+        self.silhouette_population = 0  # Number of rows (pairs or files) that were clustered
+        self.file_clusters = None  # Cluster of every file when clustering files instead of pairs
 
     def load_data(self, dataframe):
         self.data = dataframe  # Assign the provided DataFrame to the class attribute
+        self.elbow_models = {}  # Models fitted on earlier data no longer apply
 
     def cluster_codes(self):
         # Check if data is loaded and not empty
@@ -23,24 +53,37 @@ class CodeClusterer:
 
         # Select features for clustering (only the similarity columns are used)
         features = self.data[['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']]
-        # Fit the KMeans model to the selected features
-        self.model.fit(features)
+        with instrumentation.stage('kmeans_fit'):
+            labels = self._fit_labels(features)
 
         # Assign the cluster labels generated by KMeans to a new column 'Cluster' in the DataFrame
-        self.data['Cluster'] = self.model.labels_
+        self.data['Cluster'] = labels
 
-        # Calculate the average silhouette score for the clustering
-        self.silhouette_avg = silhouette_score(features, self.model.labels_)
+        # Calculate the silhouette values once, on a sample for large tables, and average them
+        self._score_silhouette(features.to_numpy(), labels)
 
-        # Calculate the Davies-Bouldin score for the clustering
-        self.davies_bouldin = davies_bouldin_score(features, self.model.labels_)
+        # Calculate the Davies-Bouldin score for the clustering (linear in the number of rows, so never sampled)
+        with instrumentation.stage('davies_bouldin'):
+            self.davies_bouldin = davies_bouldin_score(features, labels)
 
         return features  # Return the DataFrame with the selected features
 
+    def _fit_labels(self, features):
+        if self.num_clusters in self.elbow_models:
+            # Reuse the model the elbow sweep already fitted for this number of clusters
+            self.model = self.elbow_models[self.num_clusters]
+        else:
+            # Fit the KMeans model to the selected features
+            self.model = make_kmeans(self.num_clusters, len(features)).fit(features)
+        return self.model.labels_
+
     def get_clustered_data(self):
         return self.data  # Return the DataFrame with clusters assigned
 
-    def calculate_elbow(self, max_clusters=10):
+    def set_num_clusters(self, num_clusters):
+        self.num_clusters = num_clusters  # Change the number of clusters used by cluster_codes
+
+    def calculate_elbow(self, max_clusters=10, n_jobs=-1):
         # Check if data is loaded and not empty
         if self.data is None or self.data.empty:
             raise ValueError("DataFrame is empty or not loaded.")  # Raise an error if data is not loaded or is empty
@@ -48,19 +91,239 @@ class CodeClusterer:
         # Select features for calculating elbow scores
         features = self.data[['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']]
 
-        # Iterate through a range of cluster numbers from 2 to max_clusters
-        for i in range(2, max_clusters + 1):
-            model = KMeans(n_clusters=i, random_state=42)  # Initialize KMeans with the current cluster count
-            model.fit(features)  # Fit the model to the data
-            self.elbow_scores.append(model.inertia_)  # Append the inertia (elbow score) to the list
+        # Fit one model for every cluster number from 2 to max_clusters, in parallel across cores
+        cluster_counts = range(2, max_clusters + 1)
+        with instrumentation.stage('kmeans_elbow'):
+            models = Parallel(n_jobs=n_jobs)(delayed(_fit_kmeans)(i, features) for i in cluster_counts)
+
+        # Keep the models so the chosen one does not have to be fitted again
+        self.elbow_models = dict(zip(cluster_counts, models))
+        self.elbow_scores = [model.inertia_ for model in models]  # The inertia (elbow score) of each model
+
+    def cluster_files(self, method='agglomerative', eps=0.5):
+        # Check if data is loaded and not empty
+        if self.data is None or self.data.empty:
+            raise ValueError("DataFrame is empty or not loaded.")  # Raise an error if data is not loaded or is empty
+
+        # Cluster the n files on their precomputed distances instead of the n^2 pair rows
+        file_names, distances = build_distance_matrix(self.data)
+        if method == 'dbscan':
+            model = DBSCAN(eps=eps, min_samples=2, metric='precomputed')  # Files without close neighbours get -1
+        else:
+            model = AgglomerativeClustering(n_clusters=self.num_clusters, metric='precomputed', linkage='average')
+        with instrumentation.stage('file_clustering'):
+            labels = model.fit_predict(distances)
+        self.file_clusters = pd.DataFrame({'Code': file_names, 'Cluster': labels})
+
+        # A pair belongs to a cluster when both of its files do; pairs across clusters get -1
+        file_labels = dict(zip(file_names, labels))
+        code1_labels = self.data['Code1'].map(file_labels).to_numpy()
+        code2_labels = self.data['Code2'].map(file_labels).to_numpy()
+        self.data['Cluster'] = np.where(code1_labels == code2_labels, code1_labels, -1)
+
+        # Calculate the silhouette values of the files once and average them
+        self._score_silhouette(distances, labels, metric='precomputed')
+        self.davies_bouldin = None  # Davies-Bouldin needs feature vectors, which files do not have
+
+        return distances  # Return the distance matrix, used as the features of the files
+
+    def _score_silhouette(self, features, labels, metric='euclidean'):
+        # Silhouette values take O(n^2) time, so large tables are scored on a stratified sample
+        self.silhouette_population = len(labels)
+        rows = np.arange(len(labels))
+        if len(labels) > MAX_SILHOUETTE_SAMPLES and metric != 'precomputed':
+            rows = stratified_sample(labels, MAX_SILHOUETTE_SAMPLES)
+            features = features[rows]
+        self.silhouette_rows = rows
+        with instrumentation.stage('silhouette'):
+            self.silhouette_values = silhouette_samples(features, labels[rows], metric=metric)
+        self.silhouette_avg = float(self.silhouette_values.mean())  # Same value as silhouette_score on these rows
 
-    def get_silhouette_data(self, features):
-        # Calculate silhouette values for each sample in the DataFrame
+    @property
+    def silhouette_sample_size(self):
+        return 0 if self.silhouette_rows is None else len(self.silhouette_rows)  # Number of rows the silhouette score covers
+
+    def get_silhouette_data(self, features=None):
+        # Silhouette values were computed while clustering; features is kept for compatibility
+        if self.file_clusters is not None:
+            labels = self.file_clusters['Cluster'].to_numpy()  # Silhouette values of each file
+        else:
+            labels = self.data['Cluster'].to_numpy()  # Silhouette values of each (sampled) pair
         return pd.DataFrame({
-            'Cluster': self.data['Cluster'],  # Assign cluster labels
-            'Silhouette Value': silhouette_samples(features, self.data['Cluster'])  # Calculate silhouette values
+            'Cluster': labels[self.silhouette_rows],  # Assign cluster labels
+            'Silhouette Value': self.silhouette_values
         })
 
+# Function to pick about sample_size row positions with every cluster represented in proportion to its size
+def stratified_sample(labels, sample_size, random_state=42):
+    rng = np.random.RandomState(random_state)
+    clusters, counts = np.unique(labels, return_counts=True)
+    rows = []
+    for cluster, count in zip(clusters, counts):
+        members = np.flatnonzero(labels == cluster)
+        take = min(count, max(2, round(count * sample_size / len(labels))))  # Keep at least two rows of every cluster
+        rows.append(rng.choice(members, take, replace=False))
+    return np.sort(np.concatenate(rows))
+
+# Class for clustering pairs while they are being compared, in chunks of bounded size
+class StreamingCodeClusterer(CodeClusterer):
+    def __init__(self, max_clusters=10, chunk_size=STREAMING_CHUNK_SIZE):
+        super().__init__(num_clusters=2)
+        self.chunk_size = chunk_size  # Number of rows per partial_fit update
+        # One model per candidate number of clusters, all updated from the same chunks so the elbow can still be found
+        self.stream_models = {
+            num_clusters: MiniBatchKMeans(n_clusters=num_clusters, random_state=42, batch_size=chunk_size, n_init=3)
+            for num_clusters in range(2, max_clusters + 1)
+        }
+        self.pending = []  # Feature rows received but not fitted yet
+        self.pending_rows = 0
+        self.rows_consumed = 0  # Number of rows of the results buffer already consumed
+        self.results = None  # SimilarityResults buffer the rows come from, read in chunks once clustering
+
+    def consume(self, results):
+        # Feed the rows added to a SimilarityResults buffer since the last call
+        self.results = results
+        self.partial_fit(results.feature_rows(self.rows_consumed))
+        self.rows_consumed = len(results)
+
+    def _buffer_features(self):
+        # Return a view of the results buffer's feature rows when the buffer holds the loaded table, else None
+        if self.results is not None and len(self.results) == len(self.data):
+            return self.results.feature_rows()
+        return None
+
+    def _features(self):
+        # Return the (n, 3) feature rows, without a copy when they come from the results buffer
+        features = self._buffer_features()
+        return self.data[FEATURE_COLUMNS].to_numpy() if features is None else features
+
+    def _feature_chunks(self):
+        # Yield the feature rows chunk by chunk, so no pass over the table needs more than one chunk of extra memory
+        features = self._buffer_features()
+        for start in range(0, len(self.data), self.chunk_size):
+            if features is not None:
+                yield features[start:start + self.chunk_size]
+            else:
+                yield self.data[FEATURE_COLUMNS].iloc[start:start + self.chunk_size].to_numpy()
+
+    def partial_fit(self, features):
+        # Add (text, structural, weighted) percentage rows; the models are updated once a full chunk is available
+        if len(features):
+            self.pending.append(features)
+            self.pending_rows += len(features)
+        while self.pending_rows >= self.chunk_size:
+            self._flush(self.chunk_size)
+
+    def _flush(self, count):
+        pending = np.concatenate(self.pending)
+        chunk, rest = pending[:count], pending[count:]
+        self.pending = [rest] if len(rest) else []
+        self.pending_rows = len(rest)
+        with instrumentation.stage('streaming_partial_fit'):
+            for num_clusters, model in self.stream_models.items():
+                # The first update of a model needs at least as many rows as clusters
+                if hasattr(model, 'cluster_centers_') or len(chunk) >= num_clusters:
+                    model.partial_fit(chunk)
+
+    def calculate_elbow(self, max_clusters=10, n_jobs=None):
+        # Check if data is loaded and not empty
+        if self.data is None or self.data.empty:
+            raise ValueError("DataFrame is empty or not loaded.")  # Raise an error if data is not loaded or is empty
+        if self.pending_rows:
+            self._flush(self.pending_rows)  # Fit the last, partial chunk
+
+        # Score every streamed model over all rows, one chunk at a time
+        self.elbow_models = {
+            num_clusters: model for num_clusters, model in self.stream_models.items()
+            if num_clusters <= max_clusters and hasattr(model, 'cluster_centers_')
+        }
+        inertias = np.zeros(len(self.elbow_models))
+        with instrumentation.stage('kmeans_elbow'):
+            for chunk in self._feature_chunks():
+                inertias -= [model.score(chunk) for model in self.elbow_models.values()]
+        self.elbow_scores = inertias.tolist()
+
+    def _fit_labels(self, features=None):
+        if self.num_clusters not in self.elbow_models:
+            raise ValueError(f"No streamed model with {self.num_clusters} clusters; call calculate_elbow first.")
+        # Label every row with the streamed model, one chunk at a time
+        self.model = self.elbow_models[self.num_clusters]
+        labels = np.empty(len(self.data), dtype=np.int32)
+        for start, chunk in zip(range(0, len(self.data), self.chunk_size), self._feature_chunks()):
+            labels[start:start + len(chunk)] = self.model.predict(chunk)
+        return labels
+
+    def cluster_codes(self):
+        # Check if data is loaded and not empty
+        if self.data is None or self.data.empty:
+            raise ValueError("DataFrame is empty or not loaded.")  # Raise an error if data is not loaded or is empty
+
+        with instrumentation.stage('kmeans_fit'):
+            labels = self._fit_labels()
+        self.data['Cluster'] = labels
+
+        # Only the sampled rows are gathered for the silhouette values; Davies-Bouldin is computed chunk by chunk
+        self._score_silhouette(self._features(), labels)
+        with instrumentation.stage('davies_bouldin'):
+            self.davies_bouldin = self._davies_bouldin(labels)
+        return None  # The features are not materialized as a table
+
+    def _davies_bouldin(self, labels):
+        # Same value as davies_bouldin_score, from two chunked passes: the cluster centroids, then the distances to them
+        # The labels are the model's cluster numbers 0 .. num_clusters - 1, so they index the per-cluster sums directly
+        num_clusters = self.num_clusters
+        counts = np.zeros(num_clusters)
+        sums = np.zeros((num_clusters, 3))
+        for start, chunk in zip(range(0, len(labels), self.chunk_size), self._feature_chunks()):
+            chunk_labels = labels[start:start + len(chunk)]
+            counts += np.bincount(chunk_labels, minlength=num_clusters)
+            for column in range(3):
+                sums[:, column] += np.bincount(chunk_labels, weights=chunk[:, column], minlength=num_clusters)
+        present = counts > 0  # Clusters no row was assigned to do not count, as in davies_bouldin_score
+        centroids = sums / np.maximum(counts, 1)[:, None]
+
+        distance_sums = np.zeros(num_clusters)
+        for start, chunk in zip(range(0, len(labels), self.chunk_size), self._feature_chunks()):
+            chunk_labels = labels[start:start + len(chunk)]
+            distances = np.linalg.norm(chunk.astype(np.float64) - centroids[chunk_labels], axis=1)
+            distance_sums += np.bincount(chunk_labels, weights=distances, minlength=num_clusters)
+        centroids = centroids[present]
+        intra_distances = distance_sums[present] / counts[present]
+
+        centroid_distances = np.linalg.norm(centroids[:, None, :] - centroids[None, :, :], axis=2)
+        if np.allclose(intra_distances, 0) or np.allclose(centroid_distances, 0):
+            return 0.0
+        centroid_distances[centroid_distances == 0] = np.inf
+        combined = intra_distances[:, None] + intra_distances[None, :]
+        return float(np.mean(np.max(combined / centroid_distances, axis=1)))
+
+# Function to build the n x n distance matrix of the files from the pairwise weighted similarities
+def build_distance_matrix(dataframe):
+    file_names = pd.unique(dataframe[['Code1', 'Code2']].to_numpy().ravel())  # Every file, in order of appearance
+    file_index = {name: index for index, name in enumerate(file_names)}
+
+    # Pairs missing from the results are treated as completely different
+    distances = np.ones((len(file_names), len(file_names)))
+    np.fill_diagonal(distances, 0)
+
+    code1 = dataframe['Code1'].map(file_index).to_numpy()
+    code2 = dataframe['Code2'].map(file_index).to_numpy()
+    pair_distances = 1 - dataframe['Weighted_Similarity_%'].to_numpy() / 100  # Similarity percentage to distance
+    distances[code1, code2] = pair_distances
+    distances[code2, code1] = pair_distances
+    return file_names, distances
+
+# Function to find the number of file clusters with the best silhouette score
+def find_best_file_cluster_count(distances, max_clusters=10):
+    best_num_clusters, best_score = 2, -1
+    # Silhouette scores need at least 2 clusters and fewer clusters than files
+    for num_clusters in range(2, min(max_clusters, len(distances) - 1) + 1):
+        labels = AgglomerativeClustering(n_clusters=num_clusters, metric='precomputed', linkage='average').fit_predict(distances)
+        score = silhouette_score(distances, labels, metric='precomputed')
+        if score > best_score:
+            best_num_clusters, best_score = num_clusters, score
+    return best_num_clusters
+
 # Function to find the elbow point in the elbow scores
 def find_elbow_point(elbow_scores):
     # Return a default value if elbow scores are empty
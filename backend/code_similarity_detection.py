@@ -1,13 +1,14 @@
 import os
 import re
-import ast
 import io
+import hashlib
 import zipfile
-import tempfile
 import tokenize
-from difflib import SequenceMatcher
+import numpy as np
 from simhash import Simhash
-from backend.normalizedAST import normalize_ast
+from backend.normalizedAST import encode_normalized_ast, decode_ast, parse_code_to_encoded_ast, parse_code_to_ast
+from backend.structural_similarity import compare_encoded_asts, compare_ast_texts, ast_text
+from backend import instrumentation
 
 # Function to tokenize code
 def tokenize_code(code):
@@ -17,6 +18,45 @@ def tokenize_code(code):
 def generate_hash_signature(tokens):
     return Simhash(tokens).value  # Generate and return the Simhash value for the tokens
 
+# Function to calculate similarity between two hash signatures using hamming distance
+def calculate_hash_similarity(hash_signature1, hash_signature2):
+    # Calculate the Hamming distance between the two hash signatures
+    distance = bin(hash_signature1 ^ hash_signature2).count('1')
+
+    # Calculate similarity as 1 minus the normalized Hamming distance
+    similarity = 1 - (distance / 64)  # Simhash uses 64-bit hash by default
+    return similarity  # Return the calculated similarity
+
+# Lookup table holding the number of set bits of every byte value
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+# Number of matrix rows processed at once, which bounds the temporary XOR buffer
+_SIMILARITY_MATRIX_BLOCK_ROWS = 1024
+
+# Function to count the set bits of every element of a uint64 array
+def popcount64(values):
+    if hasattr(np, 'bitwise_count'):  # NumPy 2.0+ has a native popcount ufunc
+        return np.bitwise_count(values)
+    values = np.ascontiguousarray(values)
+    # Look up each of the 8 bytes of every value and add the counts up
+    return _POPCOUNT_TABLE[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1, dtype=np.uint8)
+
+# Function to calculate the text similarity matrix one block of rows at a time; yields (first row, block)
+def iter_text_similarity_blocks(hash_signatures, block_rows=_SIMILARITY_MATRIX_BLOCK_ROWS):
+    hashes = np.asarray(hash_signatures, dtype=np.uint64)  # All 64-bit Simhash values as one array
+
+    # Only one block of rows exists at a time, so the XOR buffer stays small for thousands of files
+    for start in range(0, len(hashes), block_rows):
+        distances = popcount64(hashes[start:start + block_rows, None] ^ hashes[None, :])  # Hamming distances of the block
+        yield start, 1 - (distances / 64)  # Same formula as calculate_hash_similarity
+
+# Function to calculate the text similarity of every pair of hash signatures at once
+def calculate_text_similarity_matrix(hash_signatures):
+    similarity_matrix = np.empty((len(hash_signatures), len(hash_signatures)), dtype=np.float64)
+    for start, block in iter_text_similarity_blocks(hash_signatures):
+        similarity_matrix[start:start + len(block)] = block
+    return similarity_matrix  # Return the n x n text similarity matrix
+
 # Function to calculate text similarity using hamming distance
 def calculate_text_similarity(code1, code2):
     tokens1 = tokenize_code(code1)  # Tokenize the first code snippet
@@ -25,37 +65,26 @@ def calculate_text_similarity(code1, code2):
     hash_signature1 = generate_hash_signature(tokens1)  # Generate hash signature for the first code
     hash_signature2 = generate_hash_signature(tokens2)  # Generate hash signature for the second code
     
-    # Calculate the Hamming distance between the two hash signatures
-    distance = bin(hash_signature1 ^ hash_signature2).count('1')
-    
-    # Calculate similarity as 1 minus the normalized Hamming distance
-    similarity = 1 - (distance / 64)  # Simhash uses 64-bit hash by default
-    return similarity  # Return the calculated similarity
+    return calculate_hash_similarity(hash_signature1, hash_signature2)  # Return the calculated similarity
 
 # Function to parse code to AST and normalize it
 def parse_and_normalize_code(code):
-    try:
-        tree = ast.parse(code)
-        return normalize_ast(tree)
-    except SyntaxError:
-        return None
+    return parse_code_to_ast(code)
 
 def compare_asts(ast1, ast2):
     if ast1 is None or ast2 is None:  # Check if either AST is None
         return 0  # Return 0 if either AST is None
 
-    ast_str1 = "\n".join(ast1)  # Convert the first AST to a string representation
-    ast_str2 = "\n".join(ast2)  # Convert the second AST to a string representation
-
-    similarity_ratio = SequenceMatcher(None, ast_str1, ast_str2).ratio()  # Calculate similarity using SequenceMatcher
+    # Compare the integer-encoded node sequences instead of the joined strings
+    similarity_ratio = compare_encoded_asts(encode_normalized_ast(ast1), encode_normalized_ast(ast2))
     return similarity_ratio  # Return the similarity ratio
 
 
 # Function to calculate structural similarity using AST comparison
 def calculate_structural_similarity(code1, code2):
-    ast1 = parse_and_normalize_code(code1)
-    ast2 = parse_and_normalize_code(code2)
-    similarity = compare_asts(ast1, ast2)
+    ast1 = parse_code_to_encoded_ast(code1)
+    ast2 = parse_code_to_encoded_ast(code2)
+    similarity = compare_encoded_asts(ast1, ast2)
     return similarity
 
 # Function to calculate weighted average of text and structural similarity
@@ -71,94 +100,292 @@ def calculate_weighted_similarity(text_similarity, structural_similarity):
     # Calculate the weighted similarity score
     return (text_similarity * text_weight) + (structural_similarity * structural_weight)
 
-def format_code(code):
+# Pattern of the word tokens used for the Simhash, and of a single word character
+_WORD_PATTERN = re.compile(r'\b\w+\b')
+_WORD_CHAR = re.compile(r'\w')
+
+# Token types whose text never holds a word character
+_WORDLESS_TOKENS = frozenset({tokenize.OP, tokenize.NEWLINE, tokenize.NL, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER})
+
+# Token types a string follows when it is likely a docstring
+_DOCSTRING_PREDECESSORS = frozenset({tokenize.INDENT, tokenize.NEWLINE, None})
+
+# Class for the result of a single tokenize pass over a file
+class ScannedCode:
+    def __init__(self, text, tokens, formatted_code=None):
+        self.text = text  # Code without comments and docstrings, blank lines kept; the input for ast.parse
+        self.tokens = tokens  # Word tokens of that code, the same ones tokenize_code finds in the formatted code
+        self._formatted_code = formatted_code  # Built from the text when it is first asked for
+
+    @property
+    def formatted_code(self):
+        # Drop the blank lines only when the formatted code is asked for (cache, display)
+        if self._formatted_code is None:
+            self._formatted_code = os.linesep.join([s for s in self.text.splitlines() if s.strip()])
+        return self._formatted_code
+
+# Function to strip comments and docstrings and collect the word tokens in one tokenize pass
+def scan_code(code):
     io_obj = io.StringIO(code)  # Create a StringIO object from the code string
-    out = []  # Initialize an empty list to store formatted code
+    out = []  # Initialize an empty list to store the code pieces
+    tokens = []  # Word tokens, collected token by token instead of searching the joined code again
     prev_toktype = None  # Initialize the previous token type as None
     last_lineno = -1  # Initialize the last line number
     last_col = 0  # Initialize the last column number
-    
+    joins_word = False  # Whether the code so far ends in a word character
+    COMMENT, STRING, NAME = tokenize.COMMENT, tokenize.STRING, tokenize.NAME  # Local names, looked up for every token
+    append = out.append
+
     try:
         # Iterate over tokens generated by tokenize
         for tok in tokenize.generate_tokens(io_obj.readline):
             token_type, ttext, (slineno, scol), (elineno, ecol), ltext = tok  # Unpack token properties
 
             # Skip comments and docstrings
-            if token_type == tokenize.COMMENT:  # Ignore single-line and inline comments
+            if token_type == COMMENT:  # Ignore single-line and inline comments
                 continue
-            if token_type == tokenize.STRING:  # Ignore docstrings
-                if prev_toktype in {tokenize.INDENT, tokenize.NEWLINE, None}:
+            if token_type == STRING:  # Ignore docstrings
+                if prev_toktype in _DOCSTRING_PREDECESSORS:
                     continue  # Skip if it's likely to be a docstring (e.g., after an indent or newline)
 
             if slineno > last_lineno:  # Add a new line if the current line number is greater than the last
                 last_col = 0
             if scol > last_col:  # Add spaces if the current column is greater than the last
-                out.append(" " * (scol - last_col))
-            out.append(ttext)  # Append the token text to the output list
+                append(" " * (scol - last_col))
+                joins_word = False
+            append(ttext)  # Append the token text to the output list
+
+            # Collect the word tokens; a word glued to the previous one (e.g. after a line continuation) joins it, as in the joined code
+            if token_type == NAME:  # An identifier or keyword is a single word
+                if joins_word:
+                    tokens[-1] += ttext
+                else:
+                    tokens.append(ttext)
+                joins_word = True
+            elif token_type in _WORDLESS_TOKENS:
+                joins_word = False
+            elif ttext:  # Numbers and strings can hold several words
+                words = _WORD_PATTERN.findall(ttext)
+                if words and joins_word and _WORD_CHAR.match(ttext):
+                    tokens[-1] += words.pop(0)
+                tokens.extend(words)
+                joins_word = _WORD_CHAR.match(ttext[-1]) is not None
+
             prev_toktype = token_type  # Update the previous token type
             last_col = ecol  # Update the last column number
             last_lineno = elineno  # Update the last line number
 
     except (tokenize.TokenError, IndentationError) as e:
         print(f"Error tokenizing code: {e}")  # Print an error message if tokenizing fails
-        return code  # Return the original code if there's an error
+        return ScannedCode(code, tokenize_code(code), formatted_code=code)  # Fall back to the original code if there's an error
 
-    formatted_code = "".join(out)  # Join the formatted code into a single string
-    # Remove extra blank lines and spaces
-    formatted_code = os.linesep.join([s for s in formatted_code.splitlines() if s.strip()])  # Remove extra blank lines
-    return formatted_code  # Return the formatted code
+    return ScannedCode("".join(out), tokens)
+
+# Function to strip comments, docstrings and blank lines from code
+def format_code(code):
+    return scan_code(code).formatted_code
+
+# Limits that protect extraction against zip bombs
+MAX_ARCHIVE_MEMBERS = 10_000  # Python files read from a single archive
+MAX_MEMBER_BYTES = 5 * 1024 * 1024  # Size of a single Python file
+MAX_TOTAL_BYTES = 200 * 1024 * 1024  # Size of all extracted Python files together
+
+# Function to decode Python source bytes, honouring an encoding declaration or BOM if there is one
+def decode_source(data):
+    try:
+        encoding, _ = tokenize.detect_encoding(io.BytesIO(data).readline)
+    except SyntaxError:  # Unknown or invalid encoding declaration
+        encoding = 'utf-8'
+    return data.decode(encoding, errors='replace')
+
+# Function to read the Python files of a ZIP archive straight into memory
+def _read_zip_members(uploaded_file, total_bytes):
+    members = []  # Initialize the list of (member path, content) items
+    with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:  # Open the ZIP file
+        for info in zip_ref.infolist():
+            # Only Python files count; skip directories and macOS resource forks
+            if info.is_dir() or not info.filename.endswith('.py') or info.filename.startswith('__MACOSX/'):
+                continue
+            if len(members) >= MAX_ARCHIVE_MEMBERS:
+                raise ValueError(f"{uploaded_file.name} contains more than {MAX_ARCHIVE_MEMBERS} Python files.")
+            if info.file_size > MAX_MEMBER_BYTES:
+                raise ValueError(f"{info.filename} in {uploaded_file.name} is larger than {MAX_MEMBER_BYTES // (1024 * 1024)} MB.")
+
+            with zip_ref.open(info) as member:
+                data = member.read(MAX_MEMBER_BYTES + 1)  # Never trust the declared size of a member
+            if len(data) > MAX_MEMBER_BYTES:
+                raise ValueError(f"{info.filename} in {uploaded_file.name} is larger than {MAX_MEMBER_BYTES // (1024 * 1024)} MB.")
+
+            total_bytes += len(data)
+            if total_bytes > MAX_TOTAL_BYTES:
+                raise ValueError(f"The uploaded files extract to more than {MAX_TOTAL_BYTES // (1024 * 1024)} MB of Python code.")
+            members.append((f"{uploaded_file.name}/{info.filename}", decode_source(data)))
+    return members, total_bytes
 
 # Function to extract files from upload
 def extract_files(uploaded_files):
-    temp_dir = tempfile.mkdtemp()  # Create a temporary directory
     extracted_files = []  # Initialize an empty list to store extracted file paths
     extracted_files_content = {}  # Initialize an empty dictionary to store file contents
+    total_bytes = 0  # Size of everything extracted so far
 
-    # Iterate over each uploaded file
-    for uploaded_file in uploaded_files:
-        if uploaded_file.name.endswith('.zip'):  # Check if the file is a ZIP archive
-            with zipfile.ZipFile(uploaded_file, 'r') as zip_ref:  # Open the ZIP file
-                zip_ref.extractall(temp_dir)  # Extract all files in the ZIP archive to the temporary directory
-                # Walk through the extracted files
-                for root, _, files in os.walk(temp_dir):
-                    for file in files:
-                        if file.endswith('.py'):  # Check if the file is a Python file
-                            file_path = os.path.join(root, file)  # Get the full file path
-                            with open(file_path, 'r') as f:
-                                content = f.read()  # Read the file content
-                                extracted_files_content[file_path] = content  # Store the content in the dictionary
-                            extracted_files.append(file_path)  # Add the file path to the list
-        else:
-            temp_path = os.path.join(temp_dir, uploaded_file.name)  # Create a path for the non-ZIP file
-            with open(temp_path, 'wb') as f:
-                f.write(uploaded_file.getbuffer())  # Write the uploaded file content to the path
-            if temp_path.endswith('.py'):  # Check if the file is a Python file
-                with open(temp_path, 'r') as f:
-                    content = f.read()  # Read the file content
-                    extracted_files_content[temp_path] = content  # Store the content in the dictionary
-                extracted_files.append(temp_path)  # Add the file path to the list
+    with instrumentation.stage('extract'):
+        # Iterate over each uploaded file
+        for uploaded_file in uploaded_files:
+            if uploaded_file.name.endswith('.zip'):  # Check if the file is a ZIP archive
+                # Read the Python files of this archive only, without writing anything to disk
+                members, total_bytes = _read_zip_members(uploaded_file, total_bytes)
+                for file_path, content in members:
+                    extracted_files_content[file_path] = content  # Store the content in the dictionary
+                    extracted_files.append(file_path)  # Add the file path to the list
+            elif uploaded_file.name.endswith('.py'):  # Check if the file is a Python file
+                data = bytes(uploaded_file.getbuffer())  # Read the uploaded file content
+                total_bytes += len(data)
+                if total_bytes > MAX_TOTAL_BYTES:
+                    raise ValueError(f"The uploaded files extract to more than {MAX_TOTAL_BYTES // (1024 * 1024)} MB of Python code.")
+                extracted_files_content[uploaded_file.name] = decode_source(data)  # Store the content in the dictionary
+                extracted_files.append(uploaded_file.name)  # Add the file path to the list
 
+    instrumentation.count('files_extracted', len(extracted_files))
+    instrumentation.count('bytes_extracted', total_bytes)
     return extracted_files, extracted_files_content  # Return the extracted file paths and contents
 
+# Function to read Python files from local paths: directories (searched recursively), ZIP archives or .py files
+# Files are named by their path relative to the directory they were found in, "<archive>/<member>" for ZIP
+# members and the path as given for single files, so per-student folders with the same file names stay apart
+def extract_paths(paths):
+    extracted_files = []  # Initialize an empty list to store file names
+    extracted_files_content = {}  # Initialize an empty dictionary to store file contents
+    total_bytes = 0  # Size of everything read so far
+
+    def add_file(name, content):
+        extracted_files_content[name] = content  # Store the content in the dictionary
+        extracted_files.append(name)  # Add the file name to the list
+
+    def read_file(file_path, name):
+        nonlocal total_bytes
+        if name in extracted_files_content:
+            name = file_path  # Another input already has a file with this relative name
+            if name in extracted_files_content:
+                return  # The same file was given twice
+        with open(file_path, 'rb') as f:
+            data = f.read(MAX_MEMBER_BYTES + 1)
+        if len(data) > MAX_MEMBER_BYTES:
+            raise ValueError(f"{file_path} is larger than {MAX_MEMBER_BYTES // (1024 * 1024)} MB.")
+        total_bytes += len(data)
+        if total_bytes > MAX_TOTAL_BYTES:
+            raise ValueError(f"The input files add up to more than {MAX_TOTAL_BYTES // (1024 * 1024)} MB of Python code.")
+        add_file(name, decode_source(data))
+
+    with instrumentation.stage('extract'):
+        for path in paths:
+            if os.path.isdir(path):  # Walk the directory in a stable order
+                for root, dirs, files in os.walk(path):
+                    dirs.sort()
+                    for file in sorted(files):
+                        if file.endswith('.py'):
+                            file_path = os.path.join(root, file)
+                            read_file(file_path, os.path.relpath(file_path, path).replace(os.sep, '/'))
+            elif path.endswith('.zip'):
+                with open(path, 'rb') as archive:
+                    members, total_bytes = _read_zip_members(archive, total_bytes)
+                for name, content in members:
+                    if name not in extracted_files_content:  # Skip an archive that was given twice
+                        add_file(name, content)
+            elif path.endswith('.py'):
+                read_file(path, path)
+
+    instrumentation.count('files_extracted', len(extracted_files))
+    instrumentation.count('bytes_extracted', total_bytes)
+    return extracted_files, extracted_files_content  # Return the file paths and contents
+
+# Version of the fingerprinting and scoring algorithms; bump it whenever their results change
+ALGORITHM_VERSION = 3
+
+# Function to calculate the content digest that identifies a file independently of its name
+def content_digest(code):
+    return hashlib.sha256(code.encode('utf-8', 'surrogatepass')).hexdigest()
+
+# Class holding everything the pairwise stage needs to know about a single file
+class FileFingerprint:
+    def __init__(self, name, formatted_code, tokens, simhash, encoded_ast, digest=None, scanned_code=None):
+        self.name = name  # Name of the file as extracted, as shown in the results
+        self._formatted_code = formatted_code  # File content without comments, docstrings and blank lines, or None
+        self._scanned_code = scanned_code  # Scan the formatted code is built from when it is None
+        self._tokens = tokens  # Word tokens of the formatted code, or None to derive them when needed
+        self.simhash = simhash  # 64-bit Simhash value of the tokens
+        self.encoded_ast = encoded_ast  # Node-type codes and depths of the AST, or None if the code does not parse
+        self.digest = digest  # Content digest of the original file
+        self._ast_text = None  # Joined AST lines the structural score is measured on, built on the first comparison
+
+    @property
+    def formatted_code(self):
+        if self._formatted_code is None:
+            self._formatted_code = self._scanned_code.formatted_code
+            self._scanned_code = None  # The blank-line-preserving text is no longer needed
+        return self._formatted_code
+
+    @property
+    def tokens(self):
+        if self._tokens is None:  # Fingerprints loaded from the cache only keep the formatted code
+            self._tokens = tokenize_code(self.formatted_code)
+        return self._tokens
+
+    @property
+    def ast_text(self):
+        if self._ast_text is None and self.encoded_ast is not None:  # Decode once, not once per pair
+            self._ast_text = ast_text(self.encoded_ast)
+        return self._ast_text
+
+    @property
+    def normalized_ast(self):
+        # Build the indented "<NodeType>" lines only when they are asked for
+        return decode_ast(self.encoded_ast) if self.encoded_ast is not None else None
+
+# Function to compute the fingerprint of a file once, so it can be compared against any number of files
+def fingerprint_file(file_path, code):
+    with instrumentation.stage('scan_code'):
+        scanned_code = scan_code(code)  # Strip comments and docstrings and collect the word tokens in one pass
+    with instrumentation.stage('simhash'):
+        simhash = generate_hash_signature(scanned_code.tokens)
+    with instrumentation.stage('normalize_ast'):
+        encoded_ast = parse_code_to_encoded_ast(scanned_code.text)  # Blank lines do not change the AST
+    instrumentation.count('files_fingerprinted')
+    instrumentation.count('bytes_fingerprinted', len(code))
+    return FileFingerprint(
+        name=file_path,  # Extracted file names are unique, unlike base names
+        formatted_code=None,  # Built from the scanned code when it is asked for
+        tokens=scanned_code.tokens,
+        simhash=simhash,
+        encoded_ast=encoded_ast,
+        digest=content_digest(code),
+        scanned_code=scanned_code,
+    )
+
+# Function to fingerprint every extracted file, in the same order as the file list
+def fingerprint_files(extracted_files, extracted_files_content):
+    return [fingerprint_file(file_path, extracted_files_content.get(file_path, '')) for file_path in extracted_files]
+
+# Function to compare two precomputed fingerprints and calculate similarity
+def compare_fingerprints(fingerprint1, fingerprint2):
+    text_similarity = calculate_hash_similarity(fingerprint1.simhash, fingerprint2.simhash)  # Calculate text similarity
+    with instrumentation.stage('compare_asts'):
+        structural_similarity = compare_ast_texts(fingerprint1.ast_text, fingerprint2.ast_text)  # Calculate structural similarity
+
+    weighted_similarity = calculate_weighted_similarity(text_similarity, structural_similarity)  # Calculate weighted similarity
+
+    # Return the filenames and calculated similarities
+    return fingerprint1.name, fingerprint2.name, text_similarity, structural_similarity, weighted_similarity
+
 # Function to compare files and calculate similarity
 def compare_files(file_pair, extracted_files_content):
     code1_file, code2_file = file_pair  # Unpack the file pair
 
     try:
-        # Get the contents of the two files from the dictionary
-        code1 = extracted_files_content.get(code1_file, '')
-        code2 = extracted_files_content.get(code2_file, '')
-
-        formatted_code1 = format_code(code1)  # Format the first file content
-        formatted_code2 = format_code(code2)  # Format the second file content
-
-        text_similarity = calculate_text_similarity(formatted_code1, formatted_code2)  # Calculate text similarity
-        structural_similarity = calculate_structural_similarity(formatted_code1, formatted_code2)  # Calculate structural similarity
-
-        weighted_similarity = calculate_weighted_similarity(text_similarity, structural_similarity)  # Calculate weighted similarity
+        # Fingerprint the contents of the two files from the dictionary
+        fingerprint1 = fingerprint_file(code1_file, extracted_files_content.get(code1_file, ''))
+        fingerprint2 = fingerprint_file(code2_file, extracted_files_content.get(code2_file, ''))
 
-        # Return the filenames and calculated similarities
-        return os.path.basename(code1_file), os.path.basename(code2_file), text_similarity, structural_similarity, weighted_similarity
+        return compare_fingerprints(fingerprint1, fingerprint2)  # Return the filenames and calculated similarities
 
     except IOError:
         # Return None values if there is an IOError
@@ -0,0 +1,84 @@
+#filter_index.py
+import numpy as np
+
+# Similarity columns that can be range filtered
+FILTER_COLUMNS = ['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']
+
+# Class for answering range and cluster filters on a results table without scanning every row
+class FilterIndex:
+    def __init__(self, dataframe):
+        self.num_rows = len(dataframe)
+        self.values = {}  # Values of every filter column, by row ID
+        self.orders = {}  # Row IDs of every filter column, sorted by value
+        self.sorted_values = {}  # Values of every filter column, in sorted order
+        for column in FILTER_COLUMNS:
+            values = dataframe[column].to_numpy(dtype=np.float64)
+            order = np.argsort(values, kind='stable')
+            self.values[column] = values
+            self.orders[column] = order
+            self.sorted_values[column] = values[order]
+
+        # One packed bitmap of row IDs per cluster
+        clusters = dataframe['Cluster'].to_numpy()
+        self.clusters = np.unique(clusters)
+        self.cluster_bitmaps = {cluster: np.packbits(clusters == cluster) for cluster in self.clusters}
+
+    def range_rows(self, column, low, high):
+        # Return the row IDs whose value lies in [low, high], with two binary searches
+        sorted_values = self.sorted_values[column]
+        start = np.searchsorted(sorted_values, low, side='left')
+        stop = np.searchsorted(sorted_values, high, side='right')
+        return self.orders[column][start:stop]
+
+    def cluster_bitmap(self, clusters):
+        # Return the packed union bitmap of the given clusters
+        bitmap = np.zeros((self.num_rows + 7) // 8, dtype=np.uint8)
+        for cluster in clusters:
+            if cluster in self.cluster_bitmaps:  # Unknown clusters select nothing
+                bitmap |= self.cluster_bitmaps[cluster]
+        return bitmap
+
+    def covers(self, column, low, high):
+        # Return whether [low, high] holds every value of the column, so the range filters nothing out
+        sorted_values = self.sorted_values[column]
+        return not len(sorted_values) or (low <= sorted_values[0] and high >= sorted_values[-1])
+
+    def query(self, clusters=None, ranges=None):
+        # Return the sorted row IDs in any of the clusters (None for all) whose values lie in every (low, high) range
+        ranges = ranges or {}
+        if clusters is not None and np.isin(self.clusters, list(clusters)).all():
+            clusters = None  # Every cluster is selected
+        bounds = {column: ranges[column] for column in FILTER_COLUMNS
+                  if column in ranges and not self.covers(column, *ranges[column])}
+
+        if not bounds:  # Only the clusters can filter rows out
+            if clusters is None:
+                return np.arange(self.num_rows)
+            return np.flatnonzero(np.unpackbits(self.cluster_bitmap(clusters), count=self.num_rows))
+
+        # Start from the most selective range; the other conditions are only checked on its rows
+        spans = {column: self.range_rows(column, *bounds[column]) for column in bounds}
+        narrowest = min(spans, key=lambda column: len(spans[column]))
+        rows = spans[narrowest]
+        if len(rows) > self.num_rows // 8:  # Most rows pass, so comparing whole columns beats gathering the rows
+            selected = np.ones(self.num_rows, dtype=bool)
+            for column, (low, high) in bounds.items():
+                values = self.values[column]
+                selected &= (values >= low) & (values <= high)
+            if clusters is not None:
+                selected &= np.unpackbits(self.cluster_bitmap(clusters), count=self.num_rows).view(bool)
+            return np.flatnonzero(selected)
+
+        for column in bounds:
+            if column != narrowest:
+                values = self.values[column][rows]
+                rows = rows[(values >= bounds[column][0]) & (values <= bounds[column][1])]
+
+        if clusters is not None:
+            bitmap = self.cluster_bitmap(clusters)
+            rows = rows[(bitmap[rows >> 3] >> (7 - (rows & 7))) & 1 == 1]
+
+        # Marking the rows and reading the marks back in order is linear, unlike sorting the row IDs
+        selected = np.zeros(self.num_rows, dtype=bool)
+        selected[rows] = True
+        return np.flatnonzero(selected)
@@ -0,0 +1,137 @@
+#fingerprint_cache.py
+import os
+import sys
+import time
+import sqlite3
+import tempfile
+from array import array
+from backend.code_similarity_detection import FileFingerprint, ALGORITHM_VERSION
+
+# Default location of the cache file, shared by every session on this machine
+DEFAULT_CACHE_PATH = os.path.join(tempfile.gettempdir(), "code_similarity_cache.sqlite3")
+
+# Default size cap of the cached entries; the least recently used entries are evicted above it
+DEFAULT_MAX_CACHE_BYTES = 256 * 1024 * 1024
+
+# Node-type codes depend on the Python version's ast module, so entries are only valid for the same version
+CACHE_VERSION = f"{ALGORITHM_VERSION}-py{sys.version_info.major}.{sys.version_info.minor}"
+
+# Number of digests looked up in a single query (SQLite limits the number of query parameters)
+_LOOKUP_BATCH_SIZE = 500
+
+# Class for a persistent, content-addressed store of file fingerprints
+class FingerprintCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.path = path  # Location of the SQLite file
+        self.max_bytes = max_bytes  # Size cap of all cached entries
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                digest TEXT NOT NULL,
+                version TEXT NOT NULL,
+                formatted_code TEXT NOT NULL,
+                simhash BLOB NOT NULL,
+                ast_codes BLOB,
+                ast_depths BLOB,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (digest, version)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS fingerprints_last_used ON fingerprints (last_used)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()  # Close the SQLite connection
+
+    def get_many(self, digests):
+        # Look up the cached entries of the given content digests; returns {digest: (formatted_code, simhash, encoded_ast)}
+        digests = list(set(digests))
+        entries = {}
+        for start in range(0, len(digests), _LOOKUP_BATCH_SIZE):
+            batch = digests[start:start + _LOOKUP_BATCH_SIZE]
+            rows = self.connection.execute(
+                f"SELECT digest, formatted_code, simhash, ast_codes, ast_depths FROM fingerprints "
+                f"WHERE version = ? AND digest IN ({', '.join('?' * len(batch))})",
+                [CACHE_VERSION, *batch],
+            )
+            for digest, formatted_code, simhash, ast_codes, ast_depths in rows:
+                entries[digest] = (formatted_code, int.from_bytes(simhash, 'little'), _decode_ast_blobs(ast_codes, ast_depths))
+
+        # Mark the hits as recently used so eviction keeps them
+        self.connection.executemany(
+            "UPDATE fingerprints SET last_used = ? WHERE digest = ? AND version = ?",
+            [(time.time(), digest, CACHE_VERSION) for digest in entries],
+        )
+        self.connection.commit()
+        return entries
+
+    def put_many(self, fingerprints):
+        # Store the given fingerprints under their content digests
+        now = time.time()
+        rows = []
+        for fingerprint in fingerprints:
+            ast_codes, ast_depths = _encode_ast_blobs(fingerprint.encoded_ast)
+            size = len(fingerprint.formatted_code) + len(ast_codes or b'') + len(ast_depths or b'')
+            rows.append((fingerprint.digest, CACHE_VERSION, fingerprint.formatted_code,
+                         fingerprint.simhash.to_bytes(8, 'little'), ast_codes, ast_depths, size, now))
+        self.connection.executemany("INSERT OR REPLACE INTO fingerprints VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+        self.evict()
+
+    def evict(self):
+        # Delete the least recently used entries until the cache fits under its size cap
+        total_size = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM fingerprints").fetchone()[0]
+        if total_size <= self.max_bytes:
+            return
+
+        expired = []
+        for rowid, size in self.connection.execute("SELECT rowid, size FROM fingerprints ORDER BY last_used"):
+            expired.append((rowid,))
+            total_size -= size
+            if total_size <= self.max_bytes:
+                break
+        self.connection.executemany("DELETE FROM fingerprints WHERE rowid = ?", expired)
+        self.connection.commit()
+
+    def load_fingerprints(self, items):
+        # Build fingerprints for (file path, digest) items; files missing from the cache get None
+        entries = self.get_many(digest for _, digest in items)
+        fingerprints = []
+        for file_path, digest in items:
+            if digest not in entries:
+                fingerprints.append(None)
+                continue
+            formatted_code, simhash, encoded_ast = entries[digest]
+            fingerprints.append(FileFingerprint(
+                name=file_path,
+                formatted_code=formatted_code,
+                tokens=None,  # Derived from the formatted code if they are needed
+                simhash=simhash,
+                encoded_ast=encoded_ast,
+                digest=digest,
+            ))
+        return fingerprints
+
+# Function to turn an encoded AST into two blobs for storage
+def _encode_ast_blobs(encoded_ast):
+    if encoded_ast is None:  # Code that does not parse is stored without an AST
+        return None, None
+    codes, depths = encoded_ast
+    return codes.tobytes(), depths.tobytes()
+
+# Function to turn two stored blobs back into an encoded AST
+def _decode_ast_blobs(ast_codes, ast_depths):
+    if ast_codes is None:
+        return None
+    codes = array('H')
+    codes.frombytes(ast_codes)
+    depths = array('I')
+    depths.frombytes(ast_depths)
+    return codes, depths
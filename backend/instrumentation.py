@@ -0,0 +1,146 @@
+#instrumentation.py
+import io
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+from contextvars import ContextVar
+from contextlib import contextmanager
+
+# Number of functions listed in the profile of a run report
+PROFILE_LINES = 30
+
+# Report being recorded in the current context, or None when nothing is recorded; a context variable so the
+# Streamlit sessions, each running in its own thread, record into their own reports without mixing them up
+_report = ContextVar('run_report', default=None)
+
+# Runs currently using tracemalloc, which is shared by the whole process; the last one to finish stops it
+_tracing_runs = 0
+_tracing_lock = threading.Lock()
+
+# Class for the stage timings and counters of one run
+class RunReport:
+    def __init__(self):
+        self.stages = {}  # Stage name -> [seconds, calls]
+        self.counters = {}  # Counter name -> value
+        self.wall_seconds = 0.0  # Time spent inside record_run
+        self.peak_memory_bytes = None  # Peak traced memory of this process, when tracemalloc was on
+        self.profile = None  # Text of the cProfile listing, when profiling was on
+
+    def add_time(self, name, seconds, calls=1):
+        stage = self.stages.setdefault(name, [0.0, 0])
+        stage[0] += seconds
+        stage[1] += calls
+
+    def add_count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def take_stats(self):
+        # Return the timings and counters recorded so far and start over; used to ship worker stats to the parent
+        stats = {'stages': self.stages, 'counters': self.counters}
+        self.stages, self.counters = {}, {}
+        return stats
+
+    def merge(self, stats):
+        # Add the timings and counters of another report, e.g. one recorded in a worker process
+        for name, (seconds, calls) in stats['stages'].items():
+            self.add_time(name, seconds, calls)
+        for name, amount in stats['counters'].items():
+            self.add_count(name, amount)
+
+    def to_dict(self):
+        # Return the report as plain data, ready for JSON; stage times of worker processes add up across workers
+        return {
+            'wall_seconds': self.wall_seconds,
+            'stages': {name: {'seconds': seconds, 'calls': calls} for name, (seconds, calls) in
+                       sorted(self.stages.items(), key=lambda item: item[1][0], reverse=True)},
+            'counters': dict(self.counters),
+            'peak_memory_bytes': self.peak_memory_bytes,
+            'profile': self.profile,
+        }
+
+# Context manager to time a stage of the current report; does nothing when no report is being recorded
+@contextmanager
+def stage(name):
+    report = _report.get()
+    if report is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_time(name, time.perf_counter() - start)
+
+# Function to add time measured elsewhere to a stage of the current report, e.g. the wall time of a generator
+def add_time(name, seconds):
+    report = _report.get()
+    if report is not None:
+        report.add_time(name, seconds)
+
+# Function to add to a counter of the current report (files, pairs, bytes, ...)
+def count(name, amount=1):
+    report = _report.get()
+    if report is not None:
+        report.add_count(name, amount)
+
+# Function to merge statistics from a worker process into the current report
+def merge(stats):
+    report = _report.get()
+    if report is not None and stats:
+        report.merge(stats)
+
+# Function run in a worker process so the backend functions it calls record into a report of its own
+def start_worker_report():
+    _report.set(RunReport())
+
+# Function to take the statistics a worker recorded since the last call, for sending back with its results
+def take_worker_stats():
+    report = _report.get()
+    return report.take_stats() if report is not None else None
+
+# Function to start tracemalloc for a run, or join the runs already tracing
+def _start_tracing():
+    global _tracing_runs
+    with _tracing_lock:
+        if _tracing_runs == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        elif _tracing_runs == 0:
+            return False  # Traced by someone else, who decides when to stop it
+        _tracing_runs += 1
+        return True
+
+# Function to leave tracemalloc, stopping it when no other run is tracing; returns the peak seen so far
+def _stop_tracing():
+    global _tracing_runs
+    with _tracing_lock:
+        peak = tracemalloc.get_traced_memory()[1]
+        _tracing_runs -= 1
+        if _tracing_runs == 0:
+            tracemalloc.stop()
+        return peak
+
+# Context manager to record a run into a report, optionally with cProfile (this thread only) and tracemalloc (the whole
+# process, so the peak of overlapping runs includes what the others allocated)
+@contextmanager
+def record_run(report=None, profile=False, trace_memory=False):
+    report = report or RunReport()  # An existing report can be continued, e.g. clustering after processing
+    token = _report.set(report)
+    profiler = cProfile.Profile() if profile else None
+    tracing = trace_memory and _start_tracing()
+    if profiler:
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield report
+    finally:
+        report.wall_seconds += time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            listing = io.StringIO()
+            pstats.Stats(profiler, stream=listing).sort_stats('cumulative').print_stats(PROFILE_LINES)
+            report.profile = listing.getvalue()
+        if tracing:
+            report.peak_memory_bytes = max(report.peak_memory_bytes or 0, _stop_tracing())
+        _report.reset(token)
@@ -1,25 +1,74 @@
 #normalizedAST.py
 import ast
+from array import array
 
-# Function to normalize the AST by extracting only the structure and node types
-def normalize_ast(node, level=0):
-    normalized = []
+# Every AST node type of this Python version, sorted so each type gets the same code in every process
+NODE_TYPES = sorted(name for name, obj in vars(ast).items() if isinstance(obj, type) and issubclass(obj, ast.AST))
+NODE_TYPE_CODES = {name: code for code, name in enumerate(NODE_TYPES)}
 
-    def visit(node, level):
-        # Append the type of the current AST node with indentation based on its level in the tree
-        normalized.append("    " * level + f"<{type(node).__name__}>")
+# Node-type codes by node class, filled in as classes are seen so each node costs one dictionary lookup
+_NODE_CLASS_CODES = {}
 
-        # Recursively visit the child nodes with an increased level (indentation)
-        for child in ast.iter_child_nodes(node):
-            visit(child, level + 1)
+# Function to get the small integer code of an AST node type name
+def node_type_code(name):
+    code = NODE_TYPE_CODES.get(name)
+    if code is None:  # Node types unknown at import time are interned the first time they are seen
+        code = NODE_TYPE_CODES[name] = len(NODE_TYPES)
+        NODE_TYPES.append(name)
+    return code
 
-    visit(node, level)
-    return normalized
+# Function to encode the AST structure as node-type codes plus a separate array of depths
+def encode_ast(node, level=0):
+    codes = array('H')  # Node type of every node, in visiting order
+    depths = array('I')  # Depth of every node in the tree
 
-# Function to parse and normalize code to AST
-def parse_code_to_ast(code):
+    # Walk the tree with an explicit stack, so deeply nested code cannot hit the recursion limit
+    stack = [(node, level)]
+    while stack:
+        node, level = stack.pop()
+        node_class = type(node)
+        code = _NODE_CLASS_CODES.get(node_class)
+        if code is None:
+            code = _NODE_CLASS_CODES[node_class] = node_type_code(node_class.__name__)
+        codes.append(code)
+        depths.append(level)
+
+        # Push the children in reverse so they are visited in their original order
+        children = list(ast.iter_child_nodes(node))
+        stack.extend((child, level + 1) for child in reversed(children))
+
+    return codes, depths
+
+# Function to turn an encoded AST back into the indented "<NodeType>" lines
+def decode_ast(encoded_ast):
+    codes, depths = encoded_ast
+    return ["    " * depth + f"<{NODE_TYPES[code]}>" for code, depth in zip(codes, depths)]
+
+# Function to normalize the AST by extracting only the structure and node types
+def normalize_ast(node, level=0):
+    # Each node's type with indentation based on its level in the tree
+    return decode_ast(encode_ast(node, level))
+
+# Function to encode a normalized AST as node-type codes plus a separate array of depths
+def encode_normalized_ast(normalized):
+    codes = array('H')  # Node type of every node, in visiting order
+    depths = array('I')  # Depth of every node in the tree
+    for line in normalized:
+        node = line.lstrip(' ')  # Split the indentation from the "<NodeType>" part
+        codes.append(node_type_code(node[1:-1]))
+        depths.append((len(line) - len(node)) // 4)
+    return codes, depths
+
+# Function to parse code and encode its AST
+def parse_code_to_encoded_ast(code):
     try:
         tree = ast.parse(code)
-        return normalize_ast(tree)
-    except SyntaxError:
+        return encode_ast(tree)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        # Invalid code, null bytes, or code nested too deeply for the parser
         return None
+
+# Function to parse and normalize code to AST
+def parse_code_to_ast(code):
+    encoded_ast = parse_code_to_encoded_ast(code)
+    return decode_ast(encoded_ast) if encoded_ast is not None else None
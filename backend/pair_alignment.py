@@ -0,0 +1,94 @@
+#pair_alignment.py
+import io
+import re
+import ast
+import tokenize
+from difflib import SequenceMatcher
+
+# Shortest run of equal tokens reported as a text match; shorter runs are mostly shared punctuation
+MIN_TOKEN_RUN = 5
+
+# Shortest run of equal AST nodes reported as a structural match
+MIN_NODE_RUN = 5
+
+# Number of lines of a file shown at once in the side-by-side view
+PAGE_SIZE = 200
+
+# Tokens that carry no code text
+_SKIPPED_TOKENS = {tokenize.COMMENT, tokenize.NL, tokenize.NEWLINE, tokenize.INDENT, tokenize.DEDENT, tokenize.ENDMARKER}
+
+# Function to split code into (token text, line number) items, comments and layout left out
+def positioned_tokens(code):
+    try:
+        return [(token.string, token.start[0]) for token in tokenize.generate_tokens(io.StringIO(code).readline)
+                if token.type not in _SKIPPED_TOKENS]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        # Code that does not tokenize is split into words and symbols line by line
+        return [(text, line_number) for line_number, line in enumerate(code.splitlines(), start=1)
+                for text in re.findall(r'\w+|[^\w\s]', line)]
+
+# Function to list the AST nodes of code in pre-order as ((depth, node type), line number) items
+def positioned_nodes(code):
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return []  # Code that does not parse has no structural matches
+
+    nodes = []
+    stack = [(tree, 0)]
+    while stack:
+        node, depth = stack.pop()
+        nodes.append(((depth, type(node).__name__), getattr(node, 'lineno', None)))
+        children = list(ast.iter_child_nodes(node))
+        stack.extend((child, depth + 1) for child in reversed(children))
+    return nodes
+
+# Function to align two sequences of (key, line number) items and return the matched runs as line ranges
+def _matched_line_ranges(items1, items2, min_run):
+    keys1 = [key for key, _ in items1]
+    keys2 = [key for key, _ in items2]
+    ranges = []
+    for block in SequenceMatcher(None, keys1, keys2, autojunk=False).get_matching_blocks():
+        if block.size < min_run:
+            continue
+        lines1 = [line for _, line in items1[block.a:block.a + block.size] if line is not None]
+        lines2 = [line for _, line in items2[block.b:block.b + block.size] if line is not None]
+        if lines1 and lines2:
+            ranges.append(((min(lines1), max(lines1)), (min(lines2), max(lines2))))
+    return ranges
+
+# Function to collect every line number covered by the given side (0 or 1) of matched line ranges
+def _covered_lines(ranges, side):
+    return {line for match in ranges for line in range(match[side][0], match[side][1] + 1)}
+
+# Class for the matching regions of two files, as line ranges
+class PairAlignment:
+    def __init__(self, text_matches, structural_matches):
+        self.text_matches = text_matches  # ((first, last line in file 1), (first, last line in file 2)) per token run
+        self.structural_matches = structural_matches  # The same for runs of equal AST nodes
+        self.text_lines = (_covered_lines(text_matches, 0), _covered_lines(text_matches, 1))
+        self.structural_lines = (_covered_lines(structural_matches, 0), _covered_lines(structural_matches, 1))
+
+    def line_kind(self, side, line_number):
+        # Return how a line of file 1 (side 0) or file 2 (side 1) matches: 'both', 'text', 'structure' or None
+        text = line_number in self.text_lines[side]
+        structure = line_number in self.structural_lines[side]
+        if text and structure:
+            return 'both'
+        return 'text' if text else 'structure' if structure else None
+
+# Function to compute the matching regions of two files; only called for the pair being viewed
+def align_pair(code1, code2):
+    return PairAlignment(
+        _matched_line_ranges(positioned_tokens(code1), positioned_tokens(code2), MIN_TOKEN_RUN),
+        _matched_line_ranges(positioned_nodes(code1), positioned_nodes(code2), MIN_NODE_RUN),
+    )
+
+# Function to count the pages of a file in the side-by-side view
+def page_count(code, page_size=PAGE_SIZE):
+    return max(1, -(-len(code.splitlines()) // page_size))
+
+# Function to return one page of a file as (number of its first line, its lines)
+def line_window(code, page, page_size=PAGE_SIZE):
+    start = (page - 1) * page_size
+    return start + 1, code.splitlines()[start:start + page_size]
@@ -0,0 +1,88 @@
+#pair_score_cache.py
+import time
+import sqlite3
+from backend.fingerprint_cache import DEFAULT_CACHE_PATH, CACHE_VERSION
+
+# Default number of cached pairs; the least recently used pairs are evicted above it
+DEFAULT_MAX_CACHED_PAIRS = 5_000_000
+
+# Number of cached pairs read from the database at a time
+DEFAULT_BATCH_SIZE = 10_000
+
+# Class for a persistent store of (text, structural, weighted) scores keyed by pairs of content digests; a pair is kept
+# in the order its files were compared, since the structural score depends on that order
+class PairScoreCache:
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_pairs=DEFAULT_MAX_CACHED_PAIRS):
+        self.path = path  # Location of the SQLite file, shared with the fingerprint cache
+        self.max_pairs = max_pairs  # Maximum number of cached pairs
+        self.connection = sqlite3.connect(path, timeout=30)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS pair_scores (
+                digest1 TEXT NOT NULL,
+                digest2 TEXT NOT NULL,
+                version TEXT NOT NULL,
+                text_similarity REAL NOT NULL,
+                structural_similarity REAL NOT NULL,
+                weighted_similarity REAL NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (digest1, digest2, version)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS pair_scores_last_used ON pair_scores (last_used)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()  # Close the SQLite connection
+
+    def iter_corpus_scores(self, digests, batch_size=DEFAULT_BATCH_SIZE):
+        # Yield the cached pairs whose two files are both in the corpus, in lists of up to batch_size
+        # (digest1, digest2, text, structural, weighted) rows, so the whole cache is never held at once
+        self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS corpus_digests (digest TEXT PRIMARY KEY)")
+        self.connection.execute("DELETE FROM corpus_digests")
+        self.connection.executemany("INSERT OR IGNORE INTO corpus_digests VALUES (?)", [(digest,) for digest in digests])
+        cursor = self.connection.execute("""
+            SELECT p.digest1, p.digest2, p.text_similarity, p.structural_similarity, p.weighted_similarity
+            FROM pair_scores p
+            JOIN corpus_digests a ON p.digest1 = a.digest
+            JOIN corpus_digests b ON p.digest2 = b.digest
+            WHERE p.version = ?
+        """, (CACHE_VERSION,))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+
+        # Mark the hits as recently used so eviction keeps them, in one statement instead of one per pair
+        self.connection.execute("""
+            UPDATE pair_scores SET last_used = ?
+            WHERE version = ?
+              AND digest1 IN (SELECT digest FROM corpus_digests)
+              AND digest2 IN (SELECT digest FROM corpus_digests)
+        """, (time.time(), CACHE_VERSION))
+        self.connection.commit()
+
+    def put_many(self, pair_scores):
+        # Store ((digest1, digest2), (text, structural, weighted)) items, digest1 being the file compared first
+        now = time.time()
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO pair_scores VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(*digests, CACHE_VERSION, *scores, now) for digests, scores in pair_scores],
+        )
+        self.connection.commit()
+
+    def evict(self):
+        # Delete the least recently used pairs until the cache fits under its cap
+        count = self.connection.execute("SELECT COUNT(*) FROM pair_scores").fetchone()[0]
+        if count > self.max_pairs:
+            self.connection.execute(
+                "DELETE FROM pair_scores WHERE rowid IN (SELECT rowid FROM pair_scores ORDER BY last_used LIMIT ?)",
+                (count - self.max_pairs,),
+            )
+            self.connection.commit()
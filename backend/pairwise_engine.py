@@ -0,0 +1,203 @@
+#pairwise_engine.py
+import time
+import multiprocessing
+from backend.code_similarity_detection import fingerprint_file, compare_fingerprints, content_digest
+from backend.fingerprint_cache import FingerprintCache
+from backend.pair_score_cache import PairScoreCache
+from backend.candidate_pruning import find_candidate_pairs, score_pruned_pairs, decode_pairs, DEFAULT_TEXT_SIMILARITY_THRESHOLD
+from backend import instrumentation
+
+# Number of file pairs sent to a worker in a single task
+DEFAULT_CHUNK_SIZE = 256
+
+# Fingerprints of the whole corpus, set once per worker process by the pool initializer
+_worker_fingerprints = None
+
+# Function run once in every worker process to receive the corpus fingerprints
+def _init_worker(fingerprints):
+    global _worker_fingerprints
+    _worker_fingerprints = fingerprints  # Keep the fingerprints for every batch this worker handles
+    instrumentation.start_worker_report()  # Stage timings are sent back with every batch
+
+# Function to fingerprint a single (file path, content) item inside a worker; the worker's stage timings come along
+def _fingerprint_item(item):
+    file_path, code = item  # Unpack the file path and its content
+    return fingerprint_file(file_path, code), instrumentation.take_worker_stats()
+
+# Function to compare a batch of pair indices inside a worker; the worker's stage timings come along
+def _compare_batch(batch):
+    rows = [(i, j, compare_fingerprints(_worker_fingerprints[i], _worker_fingerprints[j])) for i, j in batch]
+    instrumentation.count('pairs_compared', len(rows))
+    return rows, instrumentation.take_worker_stats()
+
+# Function to fingerprint items in a new worker pool, merging the workers' stage timings into the current report
+def _fingerprint_in_pool(items, processes):
+    fingerprints = []
+    with multiprocessing.Pool(processes, initializer=instrumentation.start_worker_report) as pool:
+        for fingerprint, stats in pool.map(_fingerprint_item, items):
+            fingerprints.append(fingerprint)
+            instrumentation.merge(stats)
+    return fingerprints
+
+# Function to group a stream of (i, j) index pairs into batches
+def batch_pairs(pairs, chunk_size=DEFAULT_CHUNK_SIZE):
+    batch = []  # Initialize the current batch
+    for pair in pairs:
+        batch.append(pair)
+        if len(batch) == chunk_size:  # Hand out the batch once it is full
+            yield batch
+            batch = []
+    if batch:  # Hand out the last, partially filled batch
+        yield batch
+
+# Function to fingerprint (file path, content) items, reusing and filling the on-disk cache when one is given
+def fingerprint_corpus(items, processes=None, cache_path=None):
+    if cache_path is None:
+        return _fingerprint_in_pool(items, processes)
+
+    with FingerprintCache(cache_path) as cache:
+        with instrumentation.stage('fingerprint_cache'):
+            fingerprints = cache.load_fingerprints([(file_path, content_digest(code)) for file_path, code in items])
+
+        # Only new or changed files are fingerprinted
+        missing = [index for index, fingerprint in enumerate(fingerprints) if fingerprint is None]
+        instrumentation.count('fingerprints_from_cache', len(items) - len(missing))
+        if missing:
+            for index, fingerprint in zip(missing, _fingerprint_in_pool([items[index] for index in missing], processes)):
+                fingerprints[index] = fingerprint
+            with instrumentation.stage('fingerprint_cache'):
+                cache.put_many(fingerprints[index] for index in missing)
+
+    return fingerprints
+
+# Class for a set of (i, j) index pairs stored as one bit per pair, far smaller than a set of tuples
+class PairBitmap:
+    def __init__(self, num_files):
+        self.num_files = num_files
+        self.bits = bytearray((num_files * num_files + 7) // 8)
+        self.count = 0  # Number of pairs in the set
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, pair):
+        code = pair[0] * self.num_files + pair[1]
+        return self.bits[code >> 3] >> (code & 7) & 1 == 1
+
+    def add(self, pair):
+        if pair not in self:
+            code = pair[0] * self.num_files + pair[1]
+            self.bits[code >> 3] |= 1 << (code & 7)
+            self.count += 1
+
+# Function to turn a batch of cached (digest1, digest2, text, structural, weighted) rows into results, adding their
+# (i, j) index pairs to cached_pairs
+def _cached_results(fingerprints, indices_by_digest, rows, cached_pairs):
+    results = []
+    for digest1, digest2, *scores in rows:
+        for i in indices_by_digest[digest1]:
+            for j in indices_by_digest[digest2]:
+                if i < j:  # Pairs are compared as (i, j), so only scores cached in that order apply
+                    cached_pairs.add((i, j))
+                    results.append((fingerprints[i].name, fingerprints[j].name, *scores))
+    return results
+
+# Function to compare every pair of files with a worker pool, yielding results as they complete
+def compare_all_pairs(extracted_files, extracted_files_content, processes=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                      prune_candidates=False, text_similarity_threshold=DEFAULT_TEXT_SIMILARITY_THRESHOLD,
+                      cache_path=None):
+    items = [(file_path, extracted_files_content.get(file_path, '')) for file_path in extracted_files]
+
+    # Fingerprint each file exactly once
+    with instrumentation.stage('fingerprint'):
+        fingerprints = fingerprint_corpus(items, processes, cache_path)
+
+    if prune_candidates:
+        # Only pairs that collide in a MinHash band or pass the text threshold get full structural scoring
+        with instrumentation.stage('candidate_pruning'):
+            candidates = find_candidate_pairs(fingerprints, text_similarity_threshold)
+        pairs_to_score = decode_pairs(candidates, len(fingerprints))  # Candidates stay one sorted array of pair codes
+        instrumentation.count('candidate_pairs', len(candidates))
+    else:
+        pairs_to_score = ((i, j) for i in range(len(fingerprints)) for j in range(i + 1, len(fingerprints)))
+
+    pair_cache = PairScoreCache(cache_path) if cache_path is not None else None
+    try:
+        # Pairs scored in earlier runs are answered from the cache, streamed in batches; only the rest go to the workers
+        cached_pairs = PairBitmap(len(fingerprints))
+        if pair_cache:
+            indices_by_digest = {}  # Identical files share a digest, so a digest can stand for several indices
+            for index, fingerprint in enumerate(fingerprints):
+                indices_by_digest.setdefault(fingerprint.digest, []).append(index)
+            cached_batches = pair_cache.iter_corpus_scores(indices_by_digest)
+            while True:
+                with instrumentation.stage('pair_score_cache'):
+                    rows = next(cached_batches, None)
+                    results = _cached_results(fingerprints, indices_by_digest, rows, cached_pairs) if rows else None
+                if results is None:
+                    break
+                yield from results
+        instrumentation.count('pairs_from_cache', len(cached_pairs))
+        if cached_pairs:
+            pairs_to_score = (pair for pair in pairs_to_score if pair not in cached_pairs)
+
+        # Ship the fingerprints to each worker once, then only send pair indices
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(fingerprints,)) as pool:
+            batch_results = pool.imap_unordered(_compare_batch, batch_pairs(pairs_to_score, chunk_size))
+
+            if prune_candidates:
+                # Score the pruned pairs in this process while the workers handle the candidates
+                yield from score_pruned_pairs(fingerprints, candidates, skip_pairs=cached_pairs)
+
+            for batch, stats in batch_results:
+                instrumentation.merge(stats)
+                if pair_cache:  # Remember the new scores for later runs
+                    with instrumentation.stage('pair_score_cache'):
+                        pair_cache.put_many(((fingerprints[i].digest, fingerprints[j].digest), result[2:]) for i, j, result in batch)
+                for _, _, result in batch:
+                    yield result  # Stream the results of each finished batch
+
+        if pair_cache:
+            pair_cache.evict()
+    finally:
+        if pair_cache:
+            pair_cache.close()
+
+# Class describing how far a pairwise run has come
+class PairwiseProgress:
+    def __init__(self, done, total, elapsed):
+        self.done = done  # Number of pairs scored so far
+        self.total = total  # Number of pairs in the whole run
+        self.elapsed = elapsed  # Seconds since the run started
+
+    @property
+    def fraction(self):
+        return self.done / self.total if self.total else 1.0  # Share of the pairs already scored
+
+    @property
+    def pairs_per_second(self):
+        return self.done / self.elapsed if self.elapsed > 0 else 0.0  # Throughput so far
+
+# Function to run the pairwise stage into a results buffer, yielding progress as pair results come in
+def run_pairwise(extracted_files, extracted_files_content, results, progress_interval=0.5, **options):
+    total = len(extracted_files) * (len(extracted_files) - 1) // 2  # Number of pairs to score
+    start = time.perf_counter()
+    last_report = start
+    done = 0
+    kept = len(results)
+
+    for result in compare_all_pairs(extracted_files, extracted_files_content, **options):
+        done += 1
+        if all(result):  # Skip failed comparisons and pairs with a zero score, as the results table always has
+            results.append(result)
+
+        now = time.perf_counter()
+        if now - last_report >= progress_interval:  # Report at most every progress_interval seconds
+            last_report = now
+            yield PairwiseProgress(done, total, now - start)
+
+    # Wall time of the whole stage, including the caller's work between progress reports
+    instrumentation.add_time('pairwise', time.perf_counter() - start)
+    instrumentation.count('pairs_scored', done)
+    instrumentation.count('pairs_in_results', len(results) - kept)
+    yield PairwiseProgress(done, total, time.perf_counter() - start)  # Final report once every pair is in
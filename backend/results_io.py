@@ -0,0 +1,70 @@
+#results_io.py
+import io
+import json
+import pandas as pd
+from backend.code_similarity_detection import ALGORITHM_VERSION
+
+# Columns of a clustered results file, as written by the App and the batch runner
+CLUSTERED_COLUMNS = ['Code1', 'Code2', 'Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%', 'Cluster']
+
+# Key of the run metadata in the Parquet schema metadata
+METADATA_KEY = b"code_similarity"
+
+# Function to import pyarrow, which is only needed for Parquet files
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("Parquet files need the pyarrow package (pip install pyarrow).") from e
+    return pyarrow, pyarrow.parquet
+
+# Function to check whether a path or uploaded file is a Parquet file, by its name
+def is_parquet(source):
+    return str(getattr(source, 'name', source)).lower().endswith('.parquet')
+
+# Function to build the metadata stored with a results file
+def build_metadata(title, num_clusters):
+    return {
+        'title': title,  # Title of the code activity
+        'algorithm_version': ALGORITHM_VERSION,  # Version of the similarity algorithms that produced the scores
+        'num_clusters': None if num_clusters is None else int(num_clusters),
+    }
+
+# Function to write results to a Parquet file (path or binary file object) with the run metadata in its schema
+def write_parquet(dataframe, destination, title="", num_clusters=None):
+    pa, pq = _import_pyarrow()
+    table = pa.Table.from_pandas(dataframe, preserve_index=False)
+    metadata = {**(table.schema.metadata or {}), METADATA_KEY: json.dumps(build_metadata(title, num_clusters)).encode()}
+    pq.write_table(table.replace_schema_metadata(metadata), destination, compression='zstd')
+
+# Function to serialize results to Parquet bytes, e.g. for a download button
+def to_parquet_bytes(dataframe, title="", num_clusters=None):
+    buffer = io.BytesIO()
+    write_parquet(dataframe, buffer, title, num_clusters)
+    return buffer.getvalue()
+
+# Function to read a results file (CSV or Parquet); returns the DataFrame and the run metadata ({} for CSV files)
+def read_results(source, columns=None):
+    # Only the given columns are read; names are matched ignoring case and surrounding spaces
+    wanted = None if columns is None else {column.strip().lower() for column in columns}
+    if is_parquet(source):
+        return _read_parquet(source, wanted)
+    usecols = None if wanted is None else (lambda column: column.strip().lower() in wanted)
+    return pd.read_csv(source, usecols=usecols), {}
+
+# Function to read the wanted columns of a Parquet file without copying the file into memory first
+def _read_parquet(source, wanted):
+    pa, pq = _import_pyarrow()
+    if hasattr(source, 'getvalue'):
+        source = pa.BufferReader(source.getvalue())  # Uploaded files are already in memory; read them in place
+        parquet_file = pq.ParquetFile(source)
+    else:
+        parquet_file = pq.ParquetFile(source, memory_map=True)  # Files on disk are memory mapped
+
+    schema = parquet_file.schema_arrow
+    names = None if wanted is None else [name for name in schema.names if name.strip().lower() in wanted]
+    table = parquet_file.read(columns=names)
+
+    metadata = (schema.metadata or {}).get(METADATA_KEY)
+    return table.to_pandas(), json.loads(metadata) if metadata else {}
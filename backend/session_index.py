@@ -0,0 +1,28 @@
+#session_index.py
+# Class for constant-time lookups of file contents and pair scores, built once when the files are processed
+class SessionIndex:
+    def __init__(self, extracted_files_content, similarity_df):
+        self.extracted_files_content = extracted_files_content  # File name, as shown in the results -> source code
+        self.similarity_df = similarity_df  # Results table the pair rows point into
+
+        # (code1, code2) -> row of the pair in the results table, and the pairs in table order for the pair picker
+        self.code_pairs = list(zip(similarity_df['Code1'].tolist(), similarity_df['Code2'].tolist()))
+        self.pair_rows = {}
+        for row, pair in enumerate(self.code_pairs):
+            self.pair_rows.setdefault(pair, row)
+
+    def content(self, name):
+        # Return the source code of a file by its name, or None if no such file was uploaded
+        return self.extracted_files_content.get(name)
+
+    def pair_row(self, code1, code2):
+        # Return the row of a pair in the results table, or None if the pair was not scored
+        return self.pair_rows.get((code1, code2))
+
+    def pair_scores(self, code1, code2):
+        # Return the (text, structural, weighted) similarity percentages of a pair, or None if the pair was not scored
+        row = self.pair_row(code1, code2)
+        if row is None:
+            return None
+        scores = self.similarity_df.iloc[row]
+        return scores['Text_Similarity_%'], scores['Structural_Similarity_%'], scores['Weighted_Similarity_%']
@@ -0,0 +1,75 @@
+#similarity_results.py
+import numpy as np
+import pandas as pd
+
+# Columns of the similarity results table
+RESULT_COLUMNS = ['Code1', 'Code2', 'Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']
+
+# Similarity columns, in the order they are stored in the scores array
+SCORE_COLUMNS = RESULT_COLUMNS[2:]
+
+# Number of rows the buffer starts with; it doubles whenever it is full
+_INITIAL_CAPACITY = 1024
+
+# Class for a growing, columnar buffer of pairwise similarity results
+class SimilarityResults:
+    def __init__(self):
+        self.names = []  # Every file name, stored once
+        self.name_ids = {}  # Position of every file name in self.names
+        self.size = 0  # Number of rows in use
+        self.ids = np.empty((_INITIAL_CAPACITY, 2), dtype=np.int32)  # File IDs of the two files of each pair
+        # Text, structural and weighted similarity of each pair, as percentages with 2 decimal places
+        self.scores = np.empty((_INITIAL_CAPACITY, 3), dtype=np.float32)
+
+    def __len__(self):
+        return self.size
+
+    def _name_id(self, name):
+        name_id = self.name_ids.get(name)
+        if name_id is None:  # First time this file name is seen
+            name_id = self.name_ids[name] = len(self.names)
+            self.names.append(name)
+        return name_id
+
+    def _grow(self):
+        # Double the capacity; views handed out earlier keep pointing at the old arrays, which stay valid
+        capacity = 2 * len(self.ids)
+        self.ids = np.resize(self.ids, (capacity, 2))
+        self.scores = np.resize(self.scores, (capacity, 3))
+
+    def append(self, result):
+        # Add one (code1, code2, text, structural, weighted) result, similarities from 0 to 1
+        code1, code2, text_similarity, structural_similarity, weighted_similarity = result
+        if self.size == len(self.ids):
+            self._grow()
+        self.ids[self.size] = (self._name_id(code1), self._name_id(code2))
+        self.scores[self.size] = (
+            round(text_similarity * 100, 2),
+            round(structural_similarity * 100, 2),
+            round(weighted_similarity * 100, 2),
+        )
+        self.size += 1
+
+    def feature_rows(self, start=0):
+        # Return a view of the rows from start on, as an (n, 3) array of text, structural and weighted percentages
+        return self.scores[start:self.size]
+
+    def top(self, count):
+        # Return the rows with the highest weighted similarity so far, as a DataFrame
+        weighted = self.scores[:self.size, 2]
+        rows = np.argpartition(weighted, -count)[-count:] if len(weighted) > count else np.arange(len(weighted))
+        rows = rows[np.argsort(weighted[rows])[::-1]]  # Highest first
+        return self._frame(self.ids[rows], self.scores[rows])
+
+    def to_dataframe(self):
+        # Return all results as a DataFrame
+        return self._frame(self.ids[:self.size], self.scores[:self.size])
+
+    def _frame(self, ids, scores):
+        # File names become categoricals over the shared name list, so each name is stored once
+        categories = pd.Index(self.names, dtype=object)
+        # float32 cannot hold values such as 50.01 exactly, so the table gets the float64 value closest to each percentage
+        frame = pd.DataFrame(scores.astype(np.float64).round(2), columns=SCORE_COLUMNS, copy=False)
+        frame.insert(0, 'Code2', pd.Categorical.from_codes(ids[:, 1], categories=categories))
+        frame.insert(0, 'Code1', pd.Categorical.from_codes(ids[:, 0], categories=categories))
+        return frame
@@ -0,0 +1,221 @@
+#structural_similarity.py
+from bisect import bisect_left
+import numpy as np
+from backend.normalizedAST import decode_ast
+
+# The structural score is SequenceMatcher(None, text1, text2).ratio() over the joined "<NodeType>" lines of both ASTs,
+# computed here without its per-character Python loop. SequenceMatcher only starts matches at characters that are not
+# "popular" in text2 (at most 1% of it once it has 200 characters); these are called anchors below. In AST text the
+# anchors are the rarer letters of node names, so nearly every run of matching anchors is a single character long.
+
+# Function to join an encoded AST back into the text the structural score is measured on; None if there is no AST
+def ast_text(encoded_ast):
+    return "\n".join(decode_ast(encoded_ast)) if encoded_ast is not None else None
+
+# Function to count the equal characters from text1[i] and text2[j] onwards, up to limit, comparing growing slices
+def _common_prefix_length(text1, i, text2, j, limit):
+    if limit <= 0 or text1[i] != text2[j]:
+        return 0
+    length, step = 1, 16
+    while length < limit:
+        end = min(limit, length + step)
+        if text1[i + length:i + end] == text2[j + length:j + end]:
+            length, step = end, step * 2
+        else:  # The first difference is in this slice; find it by halving
+            while end - length > 1:
+                middle = (length + end) // 2
+                if text1[i + length:i + middle] == text2[j + length:j + middle]:
+                    length = middle
+                else:
+                    end = middle
+            return length
+    return limit
+
+# Function to count the equal characters just before text1[i] and text2[j], up to limit
+def _common_suffix_length(text1, i, text2, j, limit):
+    if limit <= 0 or text1[i - 1] != text2[j - 1]:
+        return 0
+    length, step = 1, 16
+    while length < limit:
+        end = min(limit, length + step)
+        if text1[i - end:i - length] == text2[j - end:j - length]:
+            length, step = end, step * 2
+        else:
+            while end - length > 1:
+                middle = (length + end) // 2
+                if text1[i - middle:i - length] == text2[j - middle:j - length]:
+                    length = middle
+                else:
+                    end = middle
+            return length
+    return limit
+
+# Largest number of position pairs built at once; equal anchor pairs grow with the product of the file lengths
+_MAX_PAIRS_PER_CHUNK = 1 << 18
+
+# Function to list every (position1, position2) with equal codes, ordered by position1 and then position2, in chunks
+# of about _MAX_PAIRS_PER_CHUNK pairs
+def _iter_equal_code_pairs(codes1, positions1, codes2, positions2, num_codes):
+    counts = np.bincount(codes2, minlength=num_codes)
+    grouped2 = positions2[np.argsort(codes2, kind='stable')]  # Positions in text2 grouped by code, ascending in each group
+    starts = np.cumsum(counts) - counts
+    repeats = counts[codes1]
+    ends = np.cumsum(repeats)
+    bounds = np.searchsorted(ends, np.arange(_MAX_PAIRS_PER_CHUNK, ends[-1] if len(ends) else 0, _MAX_PAIRS_PER_CHUNK))
+    for chunk in np.split(np.arange(len(codes1)), np.unique(bounds)):
+        chunk_repeats = repeats[chunk]
+        chunk_ends = np.cumsum(chunk_repeats)
+        pairs1 = np.repeat(positions1[chunk], chunk_repeats)
+        pairs2 = grouped2[np.repeat(starts[codes1[chunk]] - (chunk_ends - chunk_repeats), chunk_repeats) + np.arange(len(pairs1))]
+        yield pairs1, pairs2
+
+# Function to find the maximal runs of three or more matching anchors, as (start1, start2, length) arrays
+def _anchor_runs(chars1, chars2, is_anchor):
+    length1, length2 = len(chars1), len(chars2)
+    bigrams1 = np.flatnonzero(is_anchor[chars1[1:]] & is_anchor[chars1[:-1]]) + 1
+    bigrams2 = np.flatnonzero(is_anchor[chars2[1:]] & is_anchor[chars2[:-1]]) + 1
+    starts1, starts2, lengths = [], [], []
+    for ends1, ends2 in _iter_equal_code_pairs(chars1[bigrams1 - 1] * 128 + chars1[bigrams1], bigrams1,
+                                               chars2[bigrams2 - 1] * 128 + chars2[bigrams2], bigrams2, 128 * 128):
+        # Keep the pairs a run ends at: the characters after them differ, are not anchors, or are past the end
+        after1, after2 = ends1 + 1, ends2 + 1
+        inside = (after1 < length1) & (after2 < length2)
+        grows = np.zeros(len(ends1), dtype=bool)
+        chars = chars1[after1[inside]]
+        grows[inside] = is_anchor[chars] & (chars == chars2[after2[inside]])
+        ends1, ends2 = ends1[~grows], ends2[~grows]
+
+        run_lengths = np.full(len(ends1), 2, np.int64)
+        growing = np.arange(len(ends1))
+        back = 2
+        while len(growing):  # Extend every run backwards while the characters before it are equal anchors
+            before1, before2 = ends1[growing] - back, ends2[growing] - back
+            inside = (before1 >= 0) & (before2 >= 0)
+            growing, before1, before2 = growing[inside], before1[inside], before2[inside]
+            chars = chars1[before1]
+            growing = growing[is_anchor[chars] & (chars == chars2[before2])]
+            run_lengths[growing] += 1
+            back += 1
+
+        # Runs of two are found again when they are needed, so only the longer (and far fewer) runs are kept
+        longer = run_lengths >= 3
+        starts1.append((ends1[longer] - run_lengths[longer] + 1).astype(np.int32))
+        starts2.append((ends2[longer] - run_lengths[longer] + 1).astype(np.int32))
+        lengths.append(run_lengths[longer].astype(np.int32))
+    if not lengths:
+        return np.empty(0, np.int32), np.empty(0, np.int32), np.empty(0, np.int32)
+    return np.concatenate(starts1), np.concatenate(starts2), np.concatenate(lengths)
+
+# Function to find the first position pair of a region whose codes are equal, in the order SequenceMatcher scans them
+# (by position in text 1, then in text 2); each side is (sorted positions, their codes, sorted positions by code)
+def _first_equal_code(side1, side2, low1, high1, low2, high2):
+    positions1, codes1, by_code1 = side1
+    positions2, codes2, by_code2 = side2
+    start1, end1 = bisect_left(positions1, low1), bisect_left(positions1, high1)
+    start2, end2 = bisect_left(positions2, low2), bisect_left(positions2, high2)
+    if end2 - start2 < end1 - start1:  # Fewer positions in region 2: look all of them up and keep the first match
+        best = None
+        for position2, code in zip(positions2[start2:end2], codes2[start2:end2]):
+            candidates = by_code1.get(code, ())
+            candidate = bisect_left(candidates, low1)
+            if candidate < len(candidates) and candidates[candidate] < high1 and (best is None or candidates[candidate] < best[0]):
+                best = candidates[candidate], position2
+        return best
+    for position1, code in zip(positions1[start1:end1], codes1[start1:end1]):  # Otherwise the first match in region 1 wins
+        candidates = by_code2.get(code, ())
+        candidate = bisect_left(candidates, low2)
+        if candidate < len(candidates) and candidates[candidate] < high2:
+            return position1, candidates[candidate]
+    return None
+
+# Function to describe where one kind of match can start in a text: the sorted positions, their codes and a dict of
+# the sorted positions of every code
+def _code_positions(codes, positions):
+    codes = codes[positions]
+    grouped, counts = positions[np.argsort(codes, kind='stable')], np.bincount(codes)
+    starts = np.cumsum(counts) - counts
+    by_code = {code: grouped[starts[code]:starts[code] + counts[code]].tolist() for code in np.flatnonzero(counts).tolist()}
+    return positions.tolist(), codes.tolist(), by_code
+
+# Function to count the characters SequenceMatcher(None, text1, text2) matches, with the same matching blocks
+def _matching_characters(text1, text2):
+    length1, length2 = len(text1), len(text2)
+    chars1 = np.frombuffer(text1.encode('ascii'), np.uint8).astype(np.int64)
+    chars2 = np.frombuffer(text2.encode('ascii'), np.uint8).astype(np.int64)
+    counts2 = np.bincount(chars2, minlength=128)
+    is_anchor = counts2 > 0
+    if length2 >= 200:
+        is_anchor &= counts2 <= length2 // 100 + 1
+
+    # Start positions of every anchor and every pair of adjacent anchors, for finding the first short match of a region
+    anchors1 = np.flatnonzero(is_anchor[chars1])
+    anchors2 = np.flatnonzero(is_anchor[chars2])
+    bigrams1 = anchors1[:-1][np.diff(anchors1) == 1] if len(anchors1) else anchors1
+    bigrams2 = anchors2[:-1][np.diff(anchors2) == 1] if len(anchors2) else anchors2
+    singles = (_code_positions(chars1, anchors1), _code_positions(chars2, anchors2))
+    pairs = (_code_positions(chars1[:-1] * 128 + chars1[1:], bigrams1), _code_positions(chars2[:-1] * 128 + chars2[1:], bigrams2))
+
+    # Same regions in the same order as SequenceMatcher.get_matching_blocks(); each region keeps the longer runs
+    # inside it, cut off at its edges
+    matched = 0
+    regions = [(0, length1, 0, length2, *_anchor_runs(chars1, chars2, is_anchor))]
+    while regions:
+        low1, high1, low2, high2, starts1, starts2, lengths = regions.pop()
+
+        # find_longest_match: the first longest run of anchors
+        best1, best2, size = low1, low2, 0
+        if len(lengths):
+            size = int(lengths.max())
+            best = np.flatnonzero(lengths == size)
+            if len(best) > 1:  # Of the longest runs, the one ending first in region 1 (and then in region 2) is found first
+                best = best[np.lexsort((starts2[best], starts1[best]))]
+            best1, best2 = int(starts1[best[0]]), int(starts2[best[0]])
+        else:  # No run of three, so the first pair of anchors wins, or else the first single anchor
+            for size, (side1, side2) in ((2, pairs), (1, singles)):
+                found = _first_equal_code(side1, side2, low1, high1 - size + 1, low2, high2 - size + 1)
+                if found:
+                    best1, best2 = found
+                    break
+            else:
+                size = 0
+
+        # The match then grows over every equal character around it, popular or not
+        before = _common_suffix_length(text1, best1, text2, best2, min(best1 - low1, best2 - low2))
+        best1, best2, size = best1 - before, best2 - before, size + before
+        size += _common_prefix_length(text1, best1 + size, text2, best2 + size, min(high1 - best1 - size, high2 - best2 - size))
+        if not size:
+            continue
+        matched += size
+
+        # Recurse into the regions before and after the match, handing each one the runs that keep three anchors in it
+        if low1 < best1 and low2 < best2:
+            if len(lengths):
+                keep = (starts1 < best1 - 2) & (starts2 < best2 - 2)
+                left1, left2, left_lengths = starts1[keep], starts2[keep], lengths[keep]
+                left_lengths = np.minimum(left_lengths, np.minimum(best1 - left1, best2 - left2))
+                regions.append((low1, best1, low2, best2, left1, left2, left_lengths))
+            else:
+                regions.append((low1, best1, low2, best2, starts1, starts2, lengths))
+        if best1 + size < high1 and best2 + size < high2:
+            if len(lengths):
+                keep = (starts1 + lengths > best1 + size + 2) & (starts2 + lengths > best2 + size + 2)
+                right1, right2, right_lengths = starts1[keep], starts2[keep], lengths[keep]
+                cut = np.maximum(0, np.maximum(best1 + size - right1, best2 + size - right2))
+                regions.append((best1 + size, high1, best2 + size, high2, right1 + cut, right2 + cut, right_lengths - cut))
+            else:
+                regions.append((best1 + size, high1, best2 + size, high2, starts1, starts2, lengths))
+    return matched
+
+# Function to compare two AST texts from ast_text(); returns SequenceMatcher(None, text1, text2).ratio()
+def compare_ast_texts(text1, text2):
+    if text1 is None or text2 is None:  # Check if either AST is None
+        return 0  # Return 0 if either AST is None
+    if text1 == text2:  # Fast path for identical structures
+        return 1.0
+
+    # SequenceMatcher is not symmetric, so the files are compared in the order they were given, as before
+    return 2 * _matching_characters(text1, text2) / (len(text1) + len(text2))
+
+# Function to compare two encoded ASTs; returns SequenceMatcher(None, text1, text2).ratio() of their joined lines
+def compare_encoded_asts(encoded_ast1, encoded_ast2):
+    return compare_ast_texts(ast_text(encoded_ast1), ast_text(encoded_ast2))
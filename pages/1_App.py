@@ -2,11 +2,74 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
-from backend.code_similarity_detection import extract_files, compare_files, sanitize_title
-from backend.code_clustering import CodeClusterer, find_elbow_point
-import os
-import difflib
-import multiprocessing
+from backend.code_similarity_detection import extract_files, sanitize_title, content_digest
+from backend.pairwise_engine import run_pairwise
+from backend.similarity_results import SimilarityResults
+from backend.results_io import to_parquet_bytes, CLUSTERED_COLUMNS
+from backend.session_index import SessionIndex
+from backend.pair_alignment import align_pair, page_count, line_window, PAGE_SIZE
+from backend.fingerprint_cache import DEFAULT_CACHE_PATH
+from backend import instrumentation
+from backend.code_clustering import CodeClusterer, find_elbow_point, build_distance_matrix, find_best_file_cluster_count
+import zipfile
+import html
+
+# Display labels and percentage format of the result columns, applied by st.dataframe instead of copying the data
+RESULT_COLUMN_CONFIG = {
+    'Code1': st.column_config.TextColumn('Code 1'),
+    'Code2': st.column_config.TextColumn('Code 2'),
+    'Text_Similarity_%': st.column_config.NumberColumn('Text Similarity %', format="%.2f%%"),
+    'Structural_Similarity_%': st.column_config.NumberColumn('Structural Similarity %', format="%.2f%%"),
+    'Weighted_Similarity_%': st.column_config.NumberColumn('Weighted Similarity %', format="%.2f%%"),
+}
+
+# Background of the lines of the side-by-side view by how they match the other file
+MATCH_BACKGROUNDS = {
+    'both': 'rgba(255, 92, 92, 0.35)',  # Same tokens and same structure
+    'text': 'rgba(255, 215, 0, 0.35)',  # Same tokens
+    'structure': 'rgba(70, 130, 180, 0.35)',  # Same structure
+}
+
+# Function to align the selected pair once per pair of file contents; other pairs are never aligned
+@st.cache_data(max_entries=32, show_spinner="Finding matching regions...")
+def cached_alignment(digest1, digest2, _code1, _code2):
+    return align_pair(_code1, _code2)
+
+# Function to render one page of a file as HTML, with its matching lines highlighted
+def render_code_window(code, alignment, side, page):
+    first_line, lines = line_window(code, page)
+    rendered = []
+    for line_number, line in enumerate(lines, start=first_line):
+        background = MATCH_BACKGROUNDS.get(alignment.line_kind(side, line_number))
+        style = f" style='background-color: {background};'" if background else ""
+        rendered.append(f"<span{style}><span style='opacity: 0.5;'>{line_number:>5}</span>  {html.escape(line) or ' '}</span>")
+    return "<pre style='font-size: 0.8em; overflow-x: auto;'>" + "\n".join(rendered) + "</pre>"
+
+# Function to show the stage timings, counters and profile of the last run
+def show_run_report(report):
+    data = report.to_dict()
+    st.caption(f"Wall time {data['wall_seconds']:.2f} s. Stage times of the worker processes add up across workers.")
+    st.dataframe(pd.DataFrame(
+        [(name, stage['seconds'], stage['calls']) for name, stage in data['stages'].items()],
+        columns=['Stage', 'Seconds', 'Calls']
+    ), hide_index=True)
+    st.dataframe(pd.DataFrame(list(data['counters'].items()), columns=['Counter', 'Value']), hide_index=True)
+    if data['profile']:
+        st.text(data['profile'])
+
+# Function to return the CSV and Parquet downloads of the clustered data, built once per clustering run instead of on every rerun
+def clustered_downloads(title):
+    downloads = st.session_state.downloads
+    df = st.session_state.clustered_data[CLUSTERED_COLUMNS]
+    if 'csv' not in downloads:
+        downloads['csv'] = df.to_csv(index=False)
+    if downloads.get('parquet_title') != title:  # The title is stored in the Parquet metadata, so a new title rebuilds it
+        try:
+            downloads['parquet'] = to_parquet_bytes(df, title=title, num_clusters=st.session_state.best_num_clusters)
+        except ImportError:
+            downloads['parquet'] = None  # pyarrow is not installed; only the CSV download is offered
+        downloads['parquet_title'] = title
+    return downloads['csv'], downloads['parquet']
 
 def main():
     st.set_page_config(
@@ -42,15 +105,25 @@ def main():
     if 'silhouette_data' not in st.session_state:
         st.session_state.silhouette_data = pd.DataFrame()
 
+    if 'silhouette_sample_size' not in st.session_state:
+        st.session_state.silhouette_sample_size = 0
+        st.session_state.silhouette_population = 0
+
     if 'extracted_files_content' not in st.session_state:
         st.session_state.extracted_files_content = {}
 
+    if 'session_index' not in st.session_state:
+        st.session_state.session_index = None  # File and pair lookups of the processed results
+
     if 'selected_pair' not in st.session_state:
         st.session_state.selected_pair = None
 
     if 'clustering_performed' not in st.session_state:
         st.session_state.clustering_performed = False
 
+    if 'downloads' not in st.session_state:
+        st.session_state.downloads = {}  # Download files of the last clustering run
+
     # File Uploader
     uploaded_files = st.file_uploader("Upload Python files (at least 5)", type=['py'], accept_multiple_files=True)
 
@@ -63,28 +136,50 @@ def main():
             st.error("Please upload more files to proceed.")
         else:
             st.write(f"Number of uploaded files: {len(uploaded_files)}")
+            fast_mode = st.checkbox(
+                "Fast mode for large uploads",
+                help="Only pairs that could reach the red band get the full structural comparison; the rest keep their text similarity and get 0% structural similarity."
+            )
+            profile_run = st.checkbox(
+                "Profile the next run",
+                help="Adds a cProfile listing of this process to the run report; the run gets somewhat slower."
+            )
             if st.button("Process Files"):
-                with st.spinner("Processing files..."):
-                    extracted_files, extracted_files_content = extract_files(uploaded_files)
+                # Time every stage of the run; worker processes send their timings back with their results
+                st.session_state.run_report = instrumentation.RunReport()
+                with instrumentation.record_run(st.session_state.run_report, profile=profile_run):
+                    try:
+                        extracted_files, extracted_files_content = extract_files(uploaded_files)
+                    except (ValueError, zipfile.BadZipFile) as e:
+                        st.error(f"Could not read the uploaded files: {str(e)}")
+                        st.stop()
                     st.session_state.extracted_files_content = extracted_files_content
-                    file_pairs = [(extracted_files[i], extracted_files[j]) for i in range(len(extracted_files)) for j in range(i + 1, len(extracted_files))]
 
-                    pool = multiprocessing.Pool()
-                    results = pool.starmap(compare_files, [(pair, st.session_state.extracted_files_content) for pair in file_pairs])
+                    # Live progress and a preview of the most similar pairs found so far
+                    progress_bar = st.progress(0.0, text="Processing files...")
+                    partial_results = st.empty()
+                    results = SimilarityResults()
+
+                    # Compare every pair of files; the corpus is sent to each worker only once and
+                    # files seen in earlier runs are taken from the fingerprint cache
+                    for progress in run_pairwise(extracted_files, extracted_files_content, results, prune_candidates=fast_mode, cache_path=DEFAULT_CACHE_PATH):
+                        progress_bar.progress(
+                            progress.fraction,
+                            text=f"Compared {progress.done:,} of {progress.total:,} pairs ({progress.pairs_per_second:,.0f} pairs/s)"
+                        )
+                        partial_results.dataframe(results.top(10), column_config=RESULT_COLUMN_CONFIG)
+                    partial_results.empty()
 
-                    results = [result for result in results if all(result)]
-                    pool.close()
-                    pool.join()
+                try:
+                    # Similarity values become float64 percentages with 2 decimal places; file names stay categoricals
+                    st.session_state.similarity_df = results.to_dataframe()
 
-                    try:
-                        # Convert similarity values to percentages and display with 2 decimal places
-                        similarity_df = pd.DataFrame(results, columns=['Code1', 'Code2', 'Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%'])
-                        similarity_df[['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']] = similarity_df[['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']].apply(lambda x: round(x * 100, 2))
-                        st.session_state.similarity_df = similarity_df
-
-                        st.success("Processing complete!")
-                    except Exception as e:
-                        st.error(f"An error occurred: {str(e)}")
+                    # Build the file and pair lookups once, so selecting a pair does not scan the files or the table
+                    st.session_state.session_index = SessionIndex(extracted_files_content, st.session_state.similarity_df)
+
+                    st.success("Processing complete!")
+                except Exception as e:
+                    st.error(f"An error occurred: {str(e)}")
     else:
         st.info('Please upload Python files.')
 
@@ -102,34 +197,48 @@ def main():
             is then calculated to give the final or weighted similarity score.
             """)
 
-        # Column renaming mapping
-        column_mapping = {
-            'Code1': 'Code 1',
-            'Code2': 'Code 2',
-            'Text_Similarity_%': 'Text Similarity %',
-            'Structural_Similarity_%': 'Structural Similarity %',
-            'Weighted_Similarity_%': 'Weighted Similarity %'
-        }
-
-        # Rename columns if they exist in the DataFrame
-        df_display = st.session_state.similarity_df.rename(columns={col: column_mapping[col] for col in st.session_state.similarity_df.columns if col in column_mapping})
-
-        # Convert similarity percentages to strings with 2 decimal places and %
-        df_display[['Text Similarity %', 'Structural Similarity %', 'Weighted Similarity %']] = df_display[['Text Similarity %', 'Structural Similarity %', 'Weighted Similarity %']].applymap(lambda x: f"{x:.2f}%")
-
-        # Display the dataframe
-        st.dataframe(df_display)
+        # Display the dataframe; column labels and the "12.34%" format are applied by the table itself, without copying the data
+        st.dataframe(st.session_state.similarity_df, column_config=RESULT_COLUMN_CONFIG)
 
         # Clustering
+        clustering_mode = st.radio(
+            "Cluster",
+            ["File pairs (K-Means)", "Files (Agglomerative)"],
+            horizontal=True,
+            help="Clustering files groups students whose files resemble each other; each pair then takes the cluster its two files share, or -1."
+        )
         if st.button("Perform Clustering"):
-            with st.spinner("Performing clustering..."):
+            # Clustering is added to the report of the processing run
+            with st.spinner("Performing clustering..."), instrumentation.record_run(st.session_state.get('run_report')):
                 clusterer = CodeClusterer(num_clusters=st.session_state.best_num_clusters)
                 clusterer.load_data(st.session_state.similarity_df)
                 
                 try:
                     # Ensure that number of clusters doesn't exceed the number of samples
                     max_clusters_possible = len(st.session_state.similarity_df)
-                    if max_clusters_possible < 2:
+                    if clustering_mode == "Files (Agglomerative)":
+                        file_names, distances = build_distance_matrix(st.session_state.similarity_df)
+                        if len(file_names) < 3:
+                            st.warning("Clustering files requires at least 3 files.")
+                        else:
+                            # Pick the number of file clusters with the best silhouette score
+                            st.session_state.best_num_clusters = find_best_file_cluster_count(distances)
+                            st.session_state.elbow_scores = []  # The elbow method only applies to K-Means
+
+                            clusterer = CodeClusterer(num_clusters=st.session_state.best_num_clusters)
+                            clusterer.load_data(st.session_state.similarity_df)
+
+                            features = clusterer.cluster_files()
+                            st.session_state.clustered_data = clusterer.get_clustered_data()
+                            st.session_state.silhouette_avg = clusterer.silhouette_avg
+                            st.session_state.silhouette_data = clusterer.get_silhouette_data(features)
+                            st.session_state.silhouette_sample_size = clusterer.silhouette_sample_size
+                            st.session_state.silhouette_population = clusterer.silhouette_population
+                            st.session_state.clustering_performed = True
+                            st.session_state.downloads = {}  # Built again from the new clusters when first shown
+
+                            st.success("Clustering complete!")
+                    elif max_clusters_possible < 2:
                         st.warning("Clustering cannot be performed because there are not enough distinct samples.")
                     else:
                         # Limit max_clusters based on number of samples
@@ -144,15 +253,17 @@ def main():
                         if st.session_state.best_num_clusters > max_clusters_possible:
                             st.warning(f"Clustering cannot be performed. The number of clusters {st.session_state.best_num_clusters} exceeds the number of samples.")
                         else:
-                            # Proceed with clustering if everything is valid
-                            clusterer = CodeClusterer(num_clusters=st.session_state.best_num_clusters)
-                            clusterer.load_data(st.session_state.similarity_df)
+                            # Proceed with clustering if everything is valid, reusing the model fitted by the elbow sweep
+                            clusterer.set_num_clusters(st.session_state.best_num_clusters)
 
                             features = clusterer.cluster_codes()
                             st.session_state.clustered_data = clusterer.get_clustered_data()
                             st.session_state.silhouette_avg = clusterer.silhouette_avg
                             st.session_state.silhouette_data = clusterer.get_silhouette_data(features)
+                            st.session_state.silhouette_sample_size = clusterer.silhouette_sample_size
+                            st.session_state.silhouette_population = clusterer.silhouette_population
                             st.session_state.clustering_performed = True
+                            st.session_state.downloads = {}  # Built again from the new clusters when first shown
 
                             st.success("Clustering complete!")
                 except ValueError as e:
@@ -161,6 +272,10 @@ def main():
                     else:
                         st.error(f"Error clustering data: {str(e)}")
 
+        # Stage timings and counters of processing and clustering
+        if 'run_report' in st.session_state:
+            with st.expander("Run report"):
+                show_run_report(st.session_state.run_report)
 
         # Display Elbow Chart and Best Number of Clusters
         if st.session_state.clustering_performed and 'elbow_scores' in st.session_state and st.session_state.elbow_scores:
@@ -233,6 +348,9 @@ def main():
                 ).interactive()
                 st.altair_chart(silhouette_chart, use_container_width=True)
                 st.write(f"Silhouette Score: {st.session_state.silhouette_avg:.4f}")
+                if st.session_state.silhouette_sample_size < st.session_state.silhouette_population:
+                    st.caption(f"Silhouette values computed on a stratified sample of {st.session_state.silhouette_sample_size:,} "
+                               f"of {st.session_state.silhouette_population:,} pairs.")
 
             # Display Clustered codes from highest to lowest weighted similarity
             st.header("Clustered Codes")
@@ -244,26 +362,11 @@ def main():
                 and structurally. This grouping can help identify patterns and relationships between the code files.
                 """)
 
-            # Column renaming mapping for the clustered data display
-            cluster_column_mapping = {
-                'Code1': 'Code 1',
-                'Code2': 'Code 2',
-                'Text_Similarity_%': 'Text Similarity %',
-                'Structural_Similarity_%': 'Structural Similarity %',
-                'Weighted_Similarity_%': 'Weighted Similarity %'
-            }
-
             # Sort clustered data by Weighted Similarity in descending order
             clustered_data_sorted = st.session_state.clustered_data.sort_values(by='Weighted_Similarity_%', ascending=False)
 
-            # Apply percentage formatting with 2 decimal places
-            clustered_data_sorted[['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']] = clustered_data_sorted[['Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%']].applymap(lambda x: f"{x:.2f}%")
-
-            # Rename columns for display
-            clustered_data_display = clustered_data_sorted.rename(columns={col: cluster_column_mapping[col] for col in clustered_data_sorted.columns if col in cluster_column_mapping})
-
-            # Display the sorted and renamed DataFrame
-            st.dataframe(clustered_data_display)
+            # Display the sorted DataFrame with the same labels and percentage format as the results table
+            st.dataframe(clustered_data_sorted, column_config=RESULT_COLUMN_CONFIG)
 
 
             # Side-by-Side Code Comparison
@@ -283,27 +386,18 @@ def main():
                 When an individual reproduces another's code but introduces significant modifications and refactors it while maintaining the core functionality, it should not be considered plagiarism. In such cases, the resulting similarity score is likely to be low.
                 """)
 
-            code_pairs = st.session_state.similarity_df[['Code1', 'Code2']].apply(tuple, axis=1).tolist()
-            selected_pair = st.selectbox("Select a pair of files to compare", options=code_pairs)
+            session_index = st.session_state.session_index
+            selected_pair = st.selectbox("Select a pair of files to compare", options=session_index.code_pairs)
             st.session_state.selected_pair = selected_pair
 
             if selected_pair:
                 code1, code2 = selected_pair
-                code1_path = [key for key in st.session_state.extracted_files_content.keys() if os.path.basename(key) == code1]
-                code2_path = [key for key in st.session_state.extracted_files_content.keys() if os.path.basename(key) == code2]
-
-                if code1_path and code2_path:
-                    code1_content = st.session_state.extracted_files_content.get(code1_path[0], "Content not found.")
-                    code2_content = st.session_state.extracted_files_content.get(code2_path[0], "Content not found.")
+                code1_content = session_index.content(code1)
+                code2_content = session_index.content(code2)
 
+                if code1_content is not None and code2_content is not None:
                     # Retrieve similarity metrics
-                    similarity_data = st.session_state.similarity_df[
-                        (st.session_state.similarity_df['Code1'] == code1) & 
-                        (st.session_state.similarity_df['Code2'] == code2)
-                    ]
-                    text_similarity = similarity_data['Text_Similarity_%'].values[0]
-                    structural_similarity = similarity_data['Structural_Similarity_%'].values[0]
-                    weighted_similarity = similarity_data['Weighted_Similarity_%'].values[0]
+                    text_similarity, structural_similarity, weighted_similarity = session_index.pair_scores(code1, code2)
 
                     # Create columns for side-by-side display
                     col1, col2 = st.columns(2)
@@ -337,6 +431,29 @@ def main():
                     code1_details = create_code_details(code1, text_similarity, structural_similarity, weighted_similarity)
                     code2_details = create_code_details(code2, text_similarity, structural_similarity, weighted_similarity)
 
+                    # Matching regions are only computed for the selected pair, and cached per pair
+                    highlight_matches = st.checkbox("Highlight matching regions", value=True)
+                    if highlight_matches:
+                        alignment = cached_alignment(content_digest(code1_content), content_digest(code2_content), code1_content, code2_content)
+                        st.markdown(
+                            f"<span style='background-color: {MATCH_BACKGROUNDS['both']};'>&nbsp;Same text and structure&nbsp;</span> "
+                            f"<span style='background-color: {MATCH_BACKGROUNDS['text']};'>&nbsp;Same text&nbsp;</span> "
+                            f"<span style='background-color: {MATCH_BACKGROUNDS['structure']};'>&nbsp;Same structure&nbsp;</span>",
+                            unsafe_allow_html=True
+                        )
+
+                    # Function to show one page of a file, so large files are never sent to the browser whole
+                    def show_code(code, side):
+                        pages = page_count(code)
+                        page = st.number_input("Page", min_value=1, max_value=pages, value=1, key=f"code_page_{side}") if pages > 1 else 1
+                        first_line, lines = line_window(code, page)
+                        if pages > 1:
+                            st.caption(f"Lines {first_line}-{first_line + len(lines) - 1} of {len(code.splitlines())} ({PAGE_SIZE} per page)")
+                        if highlight_matches:
+                            st.markdown(render_code_window(code, alignment, side, page), unsafe_allow_html=True)
+                        else:
+                            st.code("\n".join(lines), language='python')
+
                     # Display with two columns
                     col1, col2 = st.columns(2)
 
@@ -345,26 +462,33 @@ def main():
                         with st.expander("Show Details", expanded=True):
                             # Display the file details for Code 1 inside the expander
                             st.markdown(code1_details, unsafe_allow_html=True)
-                        st.code(code1_content, language='python')
+                        show_code(code1_content, 0)
 
                     with col2:
                         st.markdown("### Code 2")
                         with st.expander("Show Details", expanded=True):
                             # Display the file details for Code 2 inside the expander
                             st.markdown(code2_details, unsafe_allow_html=True)
-                        st.code(code2_content, language='python')
+                        show_code(code2_content, 1)
                                                                         
             # Display the download button in the sidebar only if clustering is done
             with st.sidebar:
                 if st.session_state.clustering_performed and not st.session_state.clustered_data.empty:
                     #st.write("Download Results")
-                    df = st.session_state.clustered_data[['Code1', 'Code2', 'Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%', 'Cluster']]
-                    csv = df.to_csv(index=False)
+                    csv, parquet = clustered_downloads(activity_title)
                     st.download_button(
                         label="Download Clustered Codes",
                         data=csv,
                         file_name=f"{sanitize_title(activity_title)}_clustered_codes.csv",
                         mime="text/csv"
                     )
+                    # Parquet keeps the column types and the run details, and loads much faster on the Analyze page
+                    if parquet is not None:
+                        st.download_button(
+                            label="Download Clustered Codes (Parquet)",
+                            data=parquet,
+                            file_name=f"{sanitize_title(activity_title)}_clustered_codes.parquet",
+                            mime="application/vnd.apache.parquet"
+                        )
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,11 +1,22 @@
 import streamlit as st
 import pandas as pd
 import altair as alt
+import hashlib
+from backend.results_io import read_results, CLUSTERED_COLUMNS
+from backend.analysis import find_missing_columns, normalize_results, summary_statistics, code_averages, band_styles, band_labels, band_summary, band_summary_styles
+from backend.filter_index import FilterIndex
 
 # Initialize session state for storing the uploaded data
 if 'df' not in st.session_state:
     st.session_state.df = None
 
+if 'dataset_key' not in st.session_state:
+    st.session_state.dataset_key = None  # Content digest of the uploaded file, the cache key of every derived table
+
+if 'upload_id' not in st.session_state:
+    st.session_state.upload_id = None  # Uploader id of the file dataset_key was computed from
+    st.session_state.upload_digest = None
+
 st.set_page_config(
     page_title="Analyze",
     page_icon="logo/logo.png",  # Set your logo image as the page icon
@@ -16,56 +27,94 @@ st.markdown("<h3 style='text-align: center; margin: 20px;'>Clustered Code Simila
 
 # Adding an introductory section with markdown
 st.markdown("""
-This application allows you to analyze clustered code similarity using a CSV file. 
+This application allows you to analyze clustered code similarity using a CSV or Parquet file. 
 Upload your data to get started and explore various interactive visualizations and filters.
 """)
 
-# Function to apply color based on similarity score
-def apply_color(val):
+# Function to apply color based on similarity score to a whole column at once (the bands are shared with the summaries)
+def apply_color(column):
     """
     Color code cells based on the Weighted Similarity percentage.
     """
-    if val >= 75:
-        color = 'background-color: #A04747'#red
-    elif 50 <= val < 75:
-        color = 'background-color: #D8A25E'#orange
-    elif 25 <= val < 50:
-        color = 'background-color: #EEDF7A'#yellow
-    elif 1 <= val < 25:
-        color = 'background-color: #557C56'#green
-    else:
-        color = 'background-color: #6A9AB0'#blue
-    return color
-
-# Uploading the CSV file
-uploaded_file = st.file_uploader("Upload a CSV file", type="csv")
+    return band_styles(column)
+
+# Display labels and percentage format of the result columns, applied by st.dataframe instead of styling every cell
+RESULT_COLUMN_CONFIG = {
+    'Code1': st.column_config.TextColumn('Code 1'),
+    'Code2': st.column_config.TextColumn('Code 2'),
+    'Text_Similarity_%': st.column_config.NumberColumn('Text Similarity %', format="%.2f%%"),
+    'Structural_Similarity_%': st.column_config.NumberColumn('Structural Similarity %', format="%.2f%%"),
+    'Weighted_Similarity_%': st.column_config.NumberColumn('Weighted Similarity %', format="%.2f%%"),
+}
+
+# Percentage format of the renamed columns of the filtered table, and the colour band that replaces the cell colours
+FILTERED_COLUMN_CONFIG = {
+    'Text Similarity %': st.column_config.NumberColumn(format="%.2f%%"),
+    'Structural Similarity %': st.column_config.NumberColumn(format="%.2f%%"),
+    'Weighted Similarity %': st.column_config.NumberColumn(format="%.2f%%"),
+    'Similarity Range': st.column_config.TextColumn(help="Colour band of the weighted similarity, see the Filtering Guide"),
+}
+
+# Function to read and normalize an uploaded file once per file content; later reruns reuse the result
+@st.cache_data(max_entries=4, show_spinner="Loading file...")
+def load_dataset(dataset_key, _uploaded_file):
+    # Read only the columns the analysis needs into a pandas DataFrame
+    df, metadata = read_results(_uploaded_file, columns=CLUSTERED_COLUMNS)
+    missing_columns = find_missing_columns(df)
+    if missing_columns:
+        return None, metadata, missing_columns
+    return normalize_results(df), metadata, []
+
+# Derived tables, computed once per uploaded dataset and shared by every rerun; the DataFrame itself is not hashed
+@st.cache_data(max_entries=4)
+def cached_summary_statistics(dataset_key, _df):
+    return summary_statistics(_df)
+
+@st.cache_data(max_entries=4)
+def cached_code_averages(dataset_key, _df):
+    return code_averages(_df)
+
+# Colour band of every pair's weighted similarity, shown as a column since the table itself is not styled
+@st.cache_resource(max_entries=4)
+def cached_band_labels(dataset_key, _df):
+    return band_labels(_df['Weighted_Similarity_%'])
+
+# Sorted indices and cluster bitmaps of a dataset, built once and shared (not copied) across reruns
+@st.cache_resource(max_entries=4)
+def cached_filter_index(dataset_key, _df):
+    return FilterIndex(_df)
+
+# Uploading the CSV or Parquet file
+uploaded_file = st.file_uploader("Upload a CSV or Parquet file", type=["csv", "parquet"])
 
 if uploaded_file is not None:
     try:
-        # Try to read the CSV file into a pandas DataFrame
-        df = pd.read_csv(uploaded_file)
+        # Hash the upload once; the reruns that follow reuse the digest kept in session_state
+        if st.session_state.upload_id != uploaded_file.file_id:
+            st.session_state.upload_digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+            st.session_state.upload_id = uploaded_file.file_id
+        dataset_key = st.session_state.upload_digest
+        df, metadata, missing_columns = load_dataset(dataset_key, uploaded_file)
 
-        # Normalize column names for consistency
-        df.columns = df.columns.str.strip().str.lower()
-
-        # Define required columns in lowercase for checking
-        required_columns = ['code1', 'code2', 'text_similarity_%', 'structural_similarity_%', 'weighted_similarity_%', 'cluster']
-
-        # Check if all required columns are present in the dataframe
-        missing_columns = [col for col in required_columns if col not in df.columns]
         if missing_columns:
             # Raise an error if any required columns are missing
             st.error(f"The uploaded file is missing the following required columns: {', '.join(missing_columns)}, try again.")
         else:
             # If no columns are missing, store the dataframe in session state
             st.session_state.df = df
+            st.session_state.dataset_key = dataset_key
             # Display a success message
-            st.success("CSV file data uploaded successfully!")
+            st.success("File data uploaded successfully!")
+            if metadata:  # Parquet files carry the details of the run that produced them
+                st.caption(f"Activity: {metadata.get('title') or 'untitled'} · Clusters: {metadata.get('num_clusters')} · "
+                           f"Algorithm version: {metadata.get('algorithm_version')}")
 
     except pd.errors.EmptyDataError:
         st.error("The uploaded file is empty. Please upload a valid CSV file.")
     except pd.errors.ParserError:
         st.error("There was an error parsing the CSV file. Please ensure the file is properly formatted.")
+    except ImportError as e:
+        st.error(str(e))  # Parquet files need pyarrow
     except Exception as e:
         # Handle general exceptions
         st.error(f"An unexpected error occurred: {e}")
@@ -76,31 +125,14 @@ if st.session_state.df is not None:
     # Display the dataframe with an expander to save space
     with st.expander("View Uploaded Data"):
         st.write("Full DataFrame")
-        # Normalize column names for consistency
-        df.columns = df.columns.str.strip().str.lower()
-
-        # Format columns to two decimal places and apply color formatting to Weighted_Similarity_%
-        df[['text_similarity_%', 'structural_similarity_%', 'weighted_similarity_%']] = df[['text_similarity_%', 'structural_similarity_%', 'weighted_similarity_%']].round(2)
-
-        styled_df = df.style.format({
-            'text_similarity_%': '{:.2f}%',
-            'structural_similarity_%': '{:.2f}%',
-            'weighted_similarity_%': '{:.2f}%'
-        }).applymap(apply_color, subset=['weighted_similarity_%'])
-        
-        st.dataframe(styled_df)
-
-    # Define required columns in lowercase
-    required_columns = ['code1', 'code2', 'text_similarity_%', 'structural_similarity_%', 'weighted_similarity_%', 'cluster']
+        # Columns were normalized and rounded to two decimal places when the file was loaded; the table only formats them
+        st.dataframe(df, column_config=RESULT_COLUMN_CONFIG)
 
     # Check if all required columns are present in the dataframe
-    if all(column in df.columns for column in required_columns):
-        # Rename columns back to original names for consistency in visualizations
-        df.columns = ['Code1', 'Code2', 'Text_Similarity_%', 'Structural_Similarity_%', 'Weighted_Similarity_%', 'Cluster']
-        
+    if all(column in df.columns for column in CLUSTERED_COLUMNS):
         # Summary statistics with an expander
         with st.expander("Summary Statistics"):
-            st.write(df.describe())
+            st.write(cached_summary_statistics(st.session_state.dataset_key, df))
 
         # Filter options in the sidebar
         st.sidebar.header('Filter Options')
@@ -109,19 +141,21 @@ if st.session_state.df is not None:
         structural_similarity_range = st.sidebar.slider('Structural Similarity Range (%)', 0.0, 100.0, (0.0, 100.0))
         weighted_similarity_range = st.sidebar.slider('Weighted Similarity Range (%)', 0.0, 100.0, (0.0, 100.0))
 
-        # Filter the dataframe based on user selection
-        filtered_df = df[
-            (df['Cluster'].isin(selected_cluster)) &
-            (df['Text_Similarity_%'].between(*text_similarity_range)) &
-            (df['Structural_Similarity_%'].between(*structural_similarity_range)) &
-            (df['Weighted_Similarity_%'].between(*weighted_similarity_range))
-        ]
+        # Filter the dataframe based on user selection, with binary searches on the pre-sorted index instead of full scans
+        filter_index = cached_filter_index(st.session_state.dataset_key, df)
+        filtered_rows = filter_index.query(clusters=selected_cluster, ranges={
+            'Text_Similarity_%': text_similarity_range,
+            'Structural_Similarity_%': structural_similarity_range,
+            'Weighted_Similarity_%': weighted_similarity_range
+        })
+        filtered_df = df.iloc[filtered_rows]
+        filtered_bands = cached_band_labels(st.session_state.dataset_key, df)[filtered_rows]
 
         # Display filtered dataframe with formatted similarity columns
         # Subheader for the filtered data section
         st.subheader("Filtered Data")
 
-        # Expander for Color Labels Explanation with styled text
+        # Expander explaining the filters and the colour bands of the Similarity Range column
         with st.expander("Filtering Guide"):
             st.markdown("""
             **Use the filters in the sidebar to refine the displayed data**:
@@ -129,7 +163,8 @@ if st.session_state.df is not None:
             - **Structural Similarity Range**: Adjust the slider to specify the range of the structural similarity percentages.
             - **Weighted Similarity Range**: This filter allows you to focus on specific weighted similarity scores.
 
-            **Color Guide for Weighted Similarity**:
+            **Similarity Range**: The last column of the table gives the colour band of each pair's weighted similarity.
+            The summary below counts the pairs of every band.
         
             <p><strong><span style='color: #6A9AB0;'>Blue</span></strong>: 0% similarity score or not similar.</p>
             
@@ -151,68 +186,17 @@ if st.session_state.df is not None:
             'Weighted_Similarity_%': 'Weighted Similarity %'
         })
 
-        # Rounding the values for better display
-        filtered_df[['Text Similarity %', 'Structural Similarity %', 'Weighted Similarity %']] = filtered_df[
-            ['Text Similarity %', 'Structural Similarity %', 'Weighted Similarity %']
-        ].round(2)
-
-        # Styling and formatting the filtered DataFrame
-        styled_filtered_df = filtered_df.style.format({
-            'Text Similarity %': '{:.2f}%',
-            'Structural Similarity %': '{:.2f}%',
-            'Weighted Similarity %': '{:.2f}%'
-        }).applymap(apply_color, subset=['Weighted Similarity %'])
-
-        # Displaying the styled DataFrame in Streamlit
-        st.dataframe(styled_filtered_df)
+        # Displaying the filtered DataFrame with the colour band of every pair; formatting is applied by the table itself
+        st.dataframe(filtered_df.assign(**{'Similarity Range': filtered_bands}), column_config=FILTERED_COLUMN_CONFIG)
 
 
          # Summary for "Filtered Data"
         with st.expander("Summary of Filtered Data"):
-            # Rename the columns for consistency and better display
-            filtered_df = filtered_df.rename(columns={
-                'Text_Similarity_%': 'Text Similarity %',
-                'Structural_Similarity_%': 'Structural Similarity %',
-                'Weighted_Similarity_%': 'Weighted Similarity %'
-            })
-
-            # Round the similarity columns to two decimal places
-            filtered_df[['Text Similarity %', 'Structural Similarity %', 'Weighted Similarity %']] = filtered_df[
-                ['Text Similarity %', 'Structural Similarity %', 'Weighted Similarity %']
-            ].round(2)
-
-            # Function to count how many entries fall into each similarity range
-            def count_by_similarity_range(df):
-                return {
-                    'Blue (0%)': df[df['Weighted Similarity %'] == 0].shape[0],
-                    'Green (1% - 24%)': df[df['Weighted Similarity %'].between(1, 24)].shape[0],
-                    'Yellow (25% - 49%)': df[df['Weighted Similarity %'].between(25, 49)].shape[0],
-                    'Orange (50% - 74%)': df[df['Weighted Similarity %'].between(50, 74)].shape[0],
-                    'Red (75% - 100%)': df[df['Weighted Similarity %'] >= 75].shape[0]
-                }
-
-            # Generate a summary of the filtered data based on similarity ranges
-            filtered_data_summary = count_by_similarity_range(filtered_df)
-
-            # Convert the summary dictionary to a DataFrame
-            summary_df = pd.DataFrame(list(filtered_data_summary.items()), columns=['Similarity Range', 'Count'])
-
-            # Function to apply background colors to the summary rows based on the similarity range
-            def apply_row_color(row):
-                if 'Blue' in row['Similarity Range']:
-                    return ['background-color: #6A9AB0'] * len(row)  # Blue
-                elif 'Green' in row['Similarity Range']:
-                    return ['background-color: #557C56'] * len(row)  # Green
-                elif 'Yellow' in row['Similarity Range']:
-                    return ['background-color: #EEDF7A'] * len(row)  # Yellow
-                elif 'Orange' in row['Similarity Range']:
-                    return ['background-color: #D8A25E'] * len(row)  # Orange
-                elif 'Red' in row['Similarity Range']:
-                    return ['background-color: #A04747'] * len(row)  # Red
-                return [''] * len(row)
+            # Count the filtered data in every similarity range with a single pass over the scores
+            summary_df = band_summary(filtered_df['Weighted Similarity %'], label_column='Similarity Range')
 
             # Apply row colors based on similarity ranges
-            styled_summary_df = summary_df.style.apply(apply_row_color, axis=1)
+            styled_summary_df = summary_df.style.apply(band_summary_styles, axis=None)
 
             # Display the styled summary DataFrame
             st.dataframe(styled_summary_df)
@@ -230,13 +214,6 @@ if st.session_state.df is not None:
             how closely related the code samples are in terms of both their text and structure.
             """)
 
-        # Rename columns for consistency and better readability in the plot
-        filtered_df = filtered_df.rename(columns={
-            'Text_Similarity_%': 'Text Similarity %',
-            'Structural_Similarity_%': 'Structural Similarity %',
-            'Weighted_Similarity_%': 'Weighted Similarity %'
-        })
-
         # Define the custom color scale based on 'Weighted Similarity %' thresholds
         color_scale = alt.Scale(
             domain=[0, 1, 25, 50, 75, 100],
@@ -270,31 +247,17 @@ if st.session_state.df is not None:
             - **Weighted Similarity**: A combined measure that takes both text and structural similarities into account, providing an overall similarity score.
             """)
 
-        # Calculate overall/average similarity for each code
-        overall_similarity = df.groupby('Code1').agg(
-            average_text_similarity=('Text_Similarity_%', 'mean'),
-            average_structural_similarity=('Structural_Similarity_%', 'mean'),
-            average_weighted_similarity=('Weighted_Similarity_%', 'mean')
-        ).reset_index()
-
-        # Handle missing data by filling NaNs with 0
-        overall_similarity.fillna(0, inplace=True)
-
-        # Round results for display
-        overall_similarity[['average_weighted_similarity', 'average_text_similarity', 'average_structural_similarity']] = overall_similarity[
-            ['average_weighted_similarity', 'average_text_similarity', 'average_structural_similarity']].round(2)
+        # Overall/average similarity for each code, sorted by weighted similarity (computed once per dataset)
+        code_averages_df = cached_code_averages(st.session_state.dataset_key, df)
 
         # Rename columns for better appearance
-        overall_similarity = overall_similarity.rename(columns={
+        overall_similarity = code_averages_df.rename(columns={
             'Code1': 'Code 1',
             'average_text_similarity': 'Average Text Similarity %',
             'average_structural_similarity': 'Average Structural Similarity %',
             'average_weighted_similarity': 'Average Weighted Similarity %'
         })
 
-        # Sort by weighted similarity (highest to lowest)
-        overall_similarity = overall_similarity.sort_values(by='Average Weighted Similarity %', ascending=False)
-
         # Sidebar filter for weighted similarity range
         weighted_similarity_range = st.sidebar.slider('Average Weighted Similarity Range (%)', 0.0, 100.0, (0.0, 100.0))
 
@@ -304,7 +267,7 @@ if st.session_state.df is not None:
         ]
 
         # Apply color-coding and percentage formatting
-        styled_filtered_overall_similarity = filtered_overall_similarity.style.applymap(
+        styled_filtered_overall_similarity = filtered_overall_similarity.style.apply(
             apply_color, subset=['Average Weighted Similarity %']
         ).format({
             'Average Weighted Similarity %': '{:.2f}%',
@@ -319,51 +282,11 @@ if st.session_state.df is not None:
         # Summary for "Each code's Average Similarity Scores"
         with st.expander("Summary of Each Code's Average Similarity Scores"):
 
-            # Calculate the average similarities
-            overall_similarity = df.groupby('Code1').agg(
-                average_text_similarity=('Text_Similarity_%', 'mean'),
-                average_structural_similarity=('Structural_Similarity_%', 'mean'),
-                average_weighted_similarity=('Weighted_Similarity_%', 'mean')
-            ).reset_index()
-
-            # Round the values to 2 decimal places
-            overall_similarity[['average_weighted_similarity', 'average_text_similarity', 'average_structural_similarity']] = overall_similarity[
-                ['average_weighted_similarity', 'average_text_similarity', 'average_structural_similarity']].round(2)
-
-            # Sort by weighted similarity
-            overall_similarity = overall_similarity.sort_values(by='average_weighted_similarity', ascending=False)
-
-            # Create a summary of counts for each color-coded range
-            def count_by_similarity_range(df):
-                return {
-                    'Blue (0%)': df[df['average_weighted_similarity'] == 0].shape[0],
-                    'Green (1% - 24%)': df[df['average_weighted_similarity'].between(1, 24)].shape[0],
-                    'Yellow (25% - 49%)': df[df['average_weighted_similarity'].between(25, 49)].shape[0],
-                    'Orange (50% - 74%)': df[df['average_weighted_similarity'].between(50, 74)].shape[0],
-                    'Red (75% - 100%)': df[df['average_weighted_similarity'] >= 75].shape[0]
-                }
-
-            # Generate the summary
-            filtered_overall_summary = count_by_similarity_range(overall_similarity)
-
-            # Display the summary in a table with color-coding
-            summary_df = pd.DataFrame(list(filtered_overall_summary.items()), columns=['Range', 'Count'])
-
-            def color_rows(row):
-                if 'Blue' in row['Range']:
-                    return ['background-color: #6A9AB0'] * len(row)
-                elif 'Green' in row['Range']:
-                    return ['background-color: #557C56'] * len(row)
-                elif 'Yellow' in row['Range']:
-                    return ['background-color: #EEDF7A'] * len(row)
-                elif 'Orange' in row['Range']:
-                    return ['background-color: #D8A25E'] * len(row)
-                elif 'Red' in row['Range']:
-                    return ['background-color: #A04747'] * len(row)
-                return [''] * len(row)
+            # Count the cached averages in every color-coded range with a single pass
+            summary_df = band_summary(code_averages_df['average_weighted_similarity'], label_column='Range')
 
             # Apply the color coding and display the table
-            st.dataframe(summary_df.style.apply(color_rows, axis=1))
+            st.dataframe(summary_df.style.apply(band_summary_styles, axis=None))
 
         st.subheader('Histograms of Similarity Metrics')
 
@@ -376,13 +299,6 @@ if st.session_state.df is not None:
                 - **Weighted Similarity Histogram**: The weighted similarity metric combines both text and structural similarities. A skew toward higher percentages might suggest that most code pairs are both textually and structurally similar. A balanced distribution across all ranges would indicate varied similarities across the dataset.
             """)
 
-        # Rename columns for consistency and better readability in the histograms
-        filtered_df = filtered_df.rename(columns={
-            'Text_Similarity_%': 'Text Similarity %',
-            'Structural_Similarity_%': 'Structural Similarity %',
-            'Weighted_Similarity_%': 'Weighted Similarity %'
-        })
-
         # Define the custom color scale based on the similarity score thresholds
         color_scale = alt.Scale(
             domain=[0, 1, 25, 50, 75, 100],
@@ -0,0 +1,42 @@
+#test_candidate_pruning.py
+import numpy as np
+import pytest
+from backend.analysis import band_codes
+from backend.benchmark import generate_corpus
+from backend.candidate_pruning import find_candidate_pairs, score_pruned_pairs, decode_pairs
+from backend.code_similarity_detection import fingerprint_files, compare_fingerprints
+
+# Lowest weighted similarity of the red band, as a fraction
+RED_BAND = 0.75
+
+# Function to fingerprint a generated corpus and score every pair in full, keyed by (i, j)
+def full_scores(num_files, seed):
+    corpus, _ = generate_corpus(num_files, seed=seed)
+    fingerprints = fingerprint_files(list(corpus), corpus)
+    scores = {}
+    for i in range(num_files):
+        for j in range(i + 1, num_files):
+            scores[(i, j)] = compare_fingerprints(fingerprints[i], fingerprints[j])[2:]
+    return fingerprints, scores
+
+@pytest.mark.parametrize('seed', range(4))
+def test_every_red_pair_is_a_candidate(seed):
+    fingerprints, scores = full_scores(30, seed)
+    candidates = set(decode_pairs(find_candidate_pairs(fingerprints), len(fingerprints)))
+    red_pairs = [pair for pair, (_, _, weighted) in scores.items() if weighted >= RED_BAND]
+    assert red_pairs
+    assert [pair for pair in red_pairs if pair not in candidates] == []
+
+@pytest.mark.parametrize('seed', range(4))
+def test_pruned_pairs_never_land_in_a_higher_band(seed):
+    fingerprints, scores = full_scores(30, seed)
+    index = {fingerprint.name: i for i, fingerprint in enumerate(fingerprints)}
+    # Without candidates every pair is pruned
+    pruned = list(score_pruned_pairs(fingerprints, np.empty(0, dtype=np.uint32)))
+    assert len(pruned) == len(scores)
+    for name1, name2, text, structural, weighted in pruned:
+        full_text, _, full_weighted = scores[(index[name1], index[name2])]
+        assert text == pytest.approx(full_text)
+        assert structural == 0.0
+        assert weighted <= full_weighted
+        assert band_codes(weighted * 100) <= band_codes(full_weighted * 100)
@@ -0,0 +1,50 @@
+#test_structural_similarity.py
+import inspect
+import difflib
+import textwrap
+import itertools
+import pytest
+from backend.benchmark import generate_corpus
+from backend.code_similarity_detection import fingerprint_file, compare_fingerprints
+from backend.normalizedAST import parse_code_to_encoded_ast
+from backend.structural_similarity import ast_text, compare_ast_texts, compare_encoded_asts
+
+# Function to get the AST text of a piece of code
+def code_ast_text(code):
+    return ast_text(parse_code_to_encoded_ast(code))
+
+# AST texts of generated submissions, including copies with renamed identifiers and reordered statements
+def generated_ast_texts():
+    corpus, _ = generate_corpus(8, functions_per_file=3, plagiarism_rate=0.5, seed=7)
+    return [code_ast_text(code) for code in corpus.values()]
+
+def test_matches_sequence_matcher_on_generated_submissions():
+    texts = generated_ast_texts()
+    assert all(len(text) >= 200 for text in texts)  # Long enough for SequenceMatcher to skip popular characters
+    for text1, text2 in itertools.permutations(texts, 2):  # SequenceMatcher is not symmetric, so test both orders
+        assert compare_ast_texts(text1, text2) == difflib.SequenceMatcher(None, text1, text2).ratio()
+
+@pytest.mark.parametrize('module1, module2', [(textwrap, difflib), (difflib, textwrap), (inspect, textwrap)])
+def test_matches_sequence_matcher_on_library_modules(module1, module2):
+    text1, text2 = code_ast_text(inspect.getsource(module1)), code_ast_text(inspect.getsource(module2))
+    assert compare_ast_texts(text1, text2) == difflib.SequenceMatcher(None, text1, text2).ratio()
+
+def test_matches_sequence_matcher_on_short_code():
+    # Below 200 characters every character can start a match
+    text1, text2 = code_ast_text("x = 1\nprint(x)"), code_ast_text("i += 1\nx = y")
+    assert len(text2) < 200
+    assert compare_ast_texts(text1, text2) == difflib.SequenceMatcher(None, text1, text2).ratio()
+
+def test_missing_and_identical_asts():
+    encoded_ast = parse_code_to_encoded_ast("x = 1")
+    assert compare_encoded_asts(encoded_ast, None) == 0
+    assert compare_encoded_asts(None, None) == 0
+    assert compare_encoded_asts(encoded_ast, encoded_ast) == 1.0
+
+def test_fingerprints_decode_their_ast_once():
+    corpus, _ = generate_corpus(2, seed=3)
+    (name1, code1), (name2, code2) = corpus.items()
+    fingerprint1, fingerprint2 = fingerprint_file(name1, code1), fingerprint_file(name2, code2)
+    structural = compare_fingerprints(fingerprint1, fingerprint2)[3]
+    assert fingerprint1.ast_text is fingerprint1.ast_text
+    assert structural == compare_encoded_asts(fingerprint1.encoded_ast, fingerprint2.encoded_ast)